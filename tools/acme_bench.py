@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+# pylint: disable=multiple-imports
+"""Benchmarks for acme_certs.py"""
+import argparse, json, math, os, subprocess, sys, tempfile, time
+
+import acme_certs
+
+
+def _rate(count, func):
+    """Call func count times, returning calls per second."""
+    started = time.perf_counter()
+    for _ in range(count):
+        func()
+    return count / (time.perf_counter() - started)
+
+
+def bench_signing(args):
+    """Signatures/sec for the in-process and openssl account key signers."""
+    if acme_certs.x509 is None:
+        print("cryptography is not installed, only the openssl signer can be measured")
+    payload = b"x" * 512
+    with tempfile.TemporaryDirectory() as keydir:
+        keys = {
+            "RS256": ["genpkey", ["-algorithm", "RSA", "-pkeyopt", "rsa_keygen_bits:2048"]],
+            "ES256": ["genpkey", ["-algorithm", "EC", "-pkeyopt", "ec_paramgen_curve:P-256"]],
+        }
+        print(f"{'alg':<6} {'signer':<10} {'sig/s':>10}")
+        for alg, (command, options) in keys.items():
+            key_file = os.path.join(keydir, f"{alg}.key")
+            acme_certs._openssl(command, options + ["-out", key_file])
+            signers = {}
+            if acme_certs.x509 is not None:
+                signers["in-process"] = acme_certs.AccountKey
+            if alg == "RS256":
+                signers["openssl"] = acme_certs.OpensslAccountKey
+            for name, signer in signers.items():
+                account_key = signer(key_file)
+                rate = _rate(args.count, lambda: account_key.sign(payload))
+                print(f"{alg:<6} {name:<10} {rate:>10.1f}")
+
+
+def bench_keys(args):
+    """Keys/sec generated for certificates, RSA 2048 and P-256."""
+    with tempfile.TemporaryDirectory() as keydir:
+        key_file = os.path.join(keydir, "cert.key")
+        print(f"{'type':<6} {'keys/s':>10}")
+        for key_type in ("rsa", "ec"):
+            rate = _rate(args.count, lambda: acme_certs.generate_key(key_type, key_file))
+            print(f"{key_type:<6} {rate:>10.1f}")
+
+
+def _percentile(values, percent):
+    """Nearest-rank percentile of a sorted list."""
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def _issue_run(args, size):
+    """Issue size certificates through acme_certs.main() against fresh stand-ins."""
+    # Only this benchmark needs the stand-ins, and they need cryptography
+    import acme_mock  # pylint: disable=import-outside-toplevel
+    ca = acme_mock.MockCA(args.latency, args.rate_limit, args.bad_nonce,
+                          args.processing_polls, args.retry_after).start()
+    do_api = acme_mock.MockDO(("example.com",), args.dns_latency).start()
+    stub = acme_mock.StubDNS(do_api.lookup, args.propagation).start()
+    cwd = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as workdir:
+            account_key = os.path.join(workdir, "account.key")
+            acme_certs.generate_key("rsa", account_key)
+            names_file = os.path.join(workdir, "names.txt")
+            with open(names_file, "w") as names:
+                names.writelines(f"bench{number}.example.com\n" for number in range(size))
+            metrics_file = os.path.join(workdir, "metrics.jsonl")
+            argv = ["--batch", names_file, "--directory", ca.directory,
+                    "--account-key", account_key, "--dns-provider", f"digitalocean:{do_api.url}",
+                    "--dns-server", stub.address, "--no-cache", "--jobs", str(args.jobs),
+                    "--metrics", metrics_file, "--budget", os.path.join(workdir, "budget.json"),
+                    "--journal", os.path.join(workdir, "journal.jsonl"),
+                    "--quiet"]
+            argv += ["--two-phase"] if args.two_phase else []
+            argv += ["--ecdsa"] if args.ecdsa else []
+            acme_certs.METRICS = acme_certs.Metrics()
+            os.chdir(workdir)
+            started = time.monotonic()
+            try:
+                if args.workers > 1:
+                    # Separate processes sharing the list through leases, as on several hosts
+                    workers = [subprocess.Popen([sys.executable, acme_certs.__file__] + argv
+                                                + ["--lease-dir", "leases", "--worker-id",
+                                                   f"worker{number}"])
+                               for number in range(args.workers)]
+                    for worker in workers:
+                        worker.wait()
+                else:
+                    acme_certs.main(argv)
+            except SystemExit:
+                pass
+            finally:
+                seconds = time.monotonic() - started
+                os.chdir(cwd)
+                for handler in list(acme_certs.LOGGER.handlers):
+                    acme_certs.LOGGER.removeHandler(handler)
+            spans, issued = {}, 0
+            with open(metrics_file) as metrics:
+                for line in metrics:
+                    record = json.loads(line)
+                    issued += bool(record.get("ok"))
+                    for span in record["spans"]:
+                        label = f'{span["phase"]}/{span["name"]}' if span["name"] else span["phase"]
+                        spans.setdefault(label, []).append(span["seconds"])
+    finally:
+        ca.stop()
+        do_api.stop()
+        stub.stop()
+    phases = {label: {"count": len(values), "p50": _percentile(sorted(values), 50),
+                      "p99": _percentile(sorted(values), 99)}
+              for label, values in sorted(spans.items())}
+    return {"size": size, "issued": issued, "seconds": round(seconds, 3),
+            "per_minute": round(issued / seconds * 60, 1),
+            "openssl": sum(phase["count"] for label, phase in phases.items()
+                           if label.startswith("openssl/")),
+            "ca_requests": ca.requests, "do_requests": do_api.requests,
+            "dns_queries": stub.queries, "phases": phases}
+
+
+def bench_issue(args):
+    """Certificates/min, per-phase latency and request counts against local stand-ins."""
+    runs = [_issue_run(args, size) for size in args.sizes]
+    for run in runs:
+        print(f"\n{run['size']} certificate(s): {run['issued']} issued in {run['seconds']}s, "
+              f"{run['per_minute']}/min; openssl runs {run['openssl']}, "
+              f"CA requests {run['ca_requests']}, DO requests {run['do_requests']}, "
+              f"DNS queries {run['dns_queries']}")
+        print(f"  {'span':<24} {'count':>7} {'p50 ms':>9} {'p99 ms':>9}")
+        for label, phase in run["phases"].items():
+            print(f"  {label:<24} {phase['count']:>7} {phase['p50'] * 1000:>9.1f} "
+                  f"{phase['p99'] * 1000:>9.1f}")
+    if args.json:
+        with open(args.json, "w") as baseline:
+            json.dump(runs, baseline, indent=1)
+
+
+def main(argv):
+    """Parse arguments and run the chosen benchmark."""
+    parser = argparse.ArgumentParser(description="Benchmarks for acme_certs.py")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+    signing = subparsers.add_parser("signing", help=bench_signing.__doc__)
+    signing.add_argument("-c", "--count", type=int, default=200,
+                         help="signatures per signer (default 200)")
+    signing.set_defaults(func=bench_signing)
+    issue = subparsers.add_parser("issue", help=bench_issue.__doc__)
+    issue.add_argument("--sizes", type=lambda sizes: [int(size) for size in sizes.split(",")],
+                       default=[1, 10, 100], metavar="N,N,...",
+                       help="batch sizes to run (default 1,10,100)")
+    issue.add_argument("-j", "--jobs", type=int, default=10, help="orders in flight (default 10)")
+    issue.add_argument("--two-phase", action="store_true", help="use --two-phase waves")
+    issue.add_argument("--workers", type=int, default=1, metavar="N",
+                       help="split each batch between N worker processes with --lease-dir "
+                       "(default 1, in this process)")
+    issue.add_argument("--ecdsa", action="store_true", help="use P-256 certificate keys")
+    issue.add_argument("--latency", type=float, default=0.0, metavar="SECONDS",
+                       help="CA response delay (default 0)")
+    issue.add_argument("--dns-latency", type=float, default=0.0, metavar="SECONDS",
+                       help="DO API response delay (default 0)")
+    issue.add_argument("--propagation", type=float, default=0.0, metavar="SECONDS",
+                       help="age before a TXT record is served by the stub DNS (default 0)")
+    issue.add_argument("--rate-limit", type=float, default=0.0, metavar="SHARE",
+                       help="share of CA requests answered 429 (default 0)")
+    issue.add_argument("--bad-nonce", type=float, default=0.0, metavar="SHARE",
+                       help="share of CA requests answered badNonce (default 0)")
+    issue.add_argument("--processing-polls", type=int, default=1, metavar="N",
+                       help="polls a challenge or finalized order stays processing (default 1)")
+    issue.add_argument("--retry-after", type=int, default=0, metavar="SECONDS",
+                       help="Retry-After given while processing (default 0)")
+    issue.add_argument("--json", metavar="FILE",
+                       help="also write the results to FILE, as a baseline to compare against")
+    issue.set_defaults(func=bench_issue)
+    keys = subparsers.add_parser("keys", help=bench_keys.__doc__)
+    keys.add_argument("-c", "--count", type=int, default=20,
+                      help="keys per type (default 20)")
+    keys.set_defaults(func=bench_keys)
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
@@ -2,25 +2,38 @@
 # Based on acme-dns-tiny https://github.com/Trim/acme-dns-tiny
 # pylint: disable=multiple-imports
 """ACME client to met DNS challenge and receive TLS certificate"""
-import argparse, base64, binascii, configparser, copy, hashlib, json, logging
-import os, re, sys, subprocess, time
+import abc, argparse, base64, binascii, calendar, configparser, contextlib, copy, email.utils
+import fcntl, hashlib, heapq, itertools, json, logging, multiprocessing, os, re, signal, socket
+import socketserver, sys, subprocess, threading, time
+from concurrent.futures import (FIRST_COMPLETED, Future, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
 import requests
 # Needs `pip3 install dnspython`
-import dns.resolver
+import dns.exception, dns.flags, dns.message, dns.query, dns.rdatatype, dns.resolver
+try:
+    # Optional `pip3 install cryptography` signs and parses keys in-process,
+    # otherwise everything falls back to the openssl command line
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa, utils
+    from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+except ImportError:
+    x509 = None
 # Timing info
 from datetime import datetime
 start=datetime.now()
-# For root domain updates
-rootdomain = False
 
 LOGGER = logging.getLogger('acme_certs')
 LOGGER.setLevel(logging.DEBUG)
+LOGFORMAT = logging.Formatter("%(asctime)s:%(levelname)s:%(message)s")
 
 # Exit codes:
 # 1 API token not set in env variable
 # 2 Adding TXT record failed
 # 3 Waited too long for DNS propagation
 # 4 Validation failed after multiple retries
+# 5 One or more certificates in a batch failed
+# 6 Rate limited, or out of rate-limit budget, at every CA
 
 # Get API token and account key from environment variables
 do_token = os.getenv('DO_KEY')
@@ -35,355 +48,3370 @@ do_base = 'https://api.digitalocean.com/v2/'
 do_headers = {'Content-Type': 'application/json',
               'Authorization': f'Bearer {do_token}'}
 
+# Budgets are {kind: (count, window seconds)}: orders per account, certificates
+# per registered domain and failed validations per hostname. ZeroSSL and Google
+# publish no such numbers, so they are assumed to match Let's Encrypt's and work
+# is spread evenly; edit them, or override them with --limit, to match your accounts.
+# They are only enforced when a budget is kept: with --budget, --limit or several --ca.
+LE_LIMITS = {"orders": (300, 3 * 3600), "certificates": (50, 7 * 24 * 3600),
+             "failures": (5, 3600)}
+STAGING_LIMITS = {"orders": (1500, 3 * 3600), "certificates": (30000, 7 * 24 * 3600),
+                  "failures": (60, 3600)}
+
+# --limit [CA:]KIND=N[/HOURS], overriding one of those
+LIMIT_SPEC = re.compile(r"^(?:([a-z-]+):)?(orders|certificates|failures)=(\d+)"
+                        r"(?:/(\d+(?:\.\d+)?))?$")
+
+# CA name: account key file, directory URL and rate-limit budget
+CAS = {
+    "letsencrypt": ("/gluster/@/api/keys/letsencrypt.key",
+                    "https://acme-v02.api.letsencrypt.org/directory", LE_LIMITS),
+    "letsencrypt-staging": ("/gluster/@/api/keys/letsencrypt.key",
+                            "https://acme-staging-v02.api.letsencrypt.org/directory",
+                            STAGING_LIMITS),
+    "zerossl": ("/gluster/@/api/keys/zerossl.key",
+                "https://acme.zerossl.com/v2/DV90", LE_LIMITS),
+    "google": ("/gluster/@/api/keys/google.key",
+               "https://dv.acme-v02.api.pki.goog/directory", LE_LIMITS),
+    "google-staging": ("/gluster/@/api/keys/google-staging.key",
+                       "https://dv.acme-v02.test-api.pki.goog/directory", STAGING_LIMITS),
+}
+
 def _base64(text):
     """Encodes string as base64 as specified in the ACME RFC."""
     return base64.urlsafe_b64encode(text).decode("utf8").rstrip("=")
 
 
+def _write_temp(path, data, mode=0o666):
+    """Write and fsync data next to path, returning the temporary name."""
+    tmp_path = os.path.join(os.path.dirname(path),
+                            f".{os.path.basename(path)}.{os.getpid()}.{threading.get_ident()}")
+    with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode),
+                   "w") as tmp_file:
+        tmp_file.write(data)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+    return tmp_path
+
+
+def _atomic_write(path, data, mode=0o666):
+    """Replace path with data, so a reader sees the old or the new file and never half of it."""
+    os.replace(_write_temp(path, data, mode), path)
+
+
+@contextlib.contextmanager
+def _file_lock(path, shared=False):
+    """Hold the lock on path.lock that runs sharing path take around using it."""
+    with open(f"{path}.lock", "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+
+
+def _read_json(path):
+    """The JSON object in path, or {} if it is missing or unreadable."""
+    try:
+        with open(path) as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return {}
+
+
+@contextlib.contextmanager
+def _update_json(path, **dump_options):
+    """Yield the JSON object in path to be changed in place, then replace the file with it.
+
+    The file is locked from before it is read until it is replaced, so
+    runs sharing it take in each other's changes instead of dropping them.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with _file_lock(path):
+        data = _read_json(path)
+        yield data
+        _atomic_write(path, json.dumps(data, **dump_options))
+
+
 def _openssl(command, options, communicate=None):
     """Run openssl command line and raise IOError on non-zero return."""
-    openssl = subprocess.Popen(["openssl", command] + options,
-                               stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-    out, err = openssl.communicate(communicate)
+    with METRICS.span("openssl", command):
+        openssl = subprocess.Popen(["openssl", command] + options,
+                                   stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        out, err = openssl.communicate(communicate)
     if openssl.returncode != 0:
         raise IOError("OpenSSL Error: {0}".format(err))
     return out
 
-# pylint: disable=too-many-locals,too-many-branches,too-many-statements
-def get_crt(config, log=LOGGER):
-    """Get ACME certificate by resolving DNS challenge."""
 
-    def create_txt(domain,keydigest64):
-        log.info(do_token)
-        log.info('Creating TXT record on Digital Ocean')
-        split_domain=domain.split(".",2)
-        if rootdomain:
-            chal_domain=split_domain[0]
-            base_domain=split_domain[1]+"."+split_domain[2]
+def _int_bytes(number, length=None):
+    """Big-endian bytes of an integer, as used by JWK and JWS."""
+    return number.to_bytes(length or (number.bit_length() + 7) // 8, "big")
+
+
+class Metrics:
+    """Timing spans for each phase of an order and each external call.
+
+    A span is opened with `with METRICS.span(phase, name):` and records its
+    duration, plus the retries and backoff time reported through retry()
+    and sleep() while it is the innermost open span on its thread. Spans
+    are aggregated into histograms per (phase, name), and those opened
+    while a certificate is bound to the thread with certificate() or bind()
+    are also kept for that certificate's JSON line.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.spans = {}
+        self.certs = {}
+        self.results = {}
+        self.unbound = []
+        self.jsonl_file = None
+
+    def _stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def _observe(self, key, seconds):
+        histogram = self.spans.setdefault(
+            key, {"buckets": [0] * len(self.BUCKETS), "sum": 0.0, "count": 0,
+                  "retries": 0, "backoff": 0.0})
+        for index, bound in enumerate(self.BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][index] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+        return histogram
+
+    @contextlib.contextmanager
+    def span(self, phase, name=""):
+        record = {"phase": phase, "name": name, "retries": 0, "backoff": 0.0,
+                  "depth": len(self._stack())}
+        cert = getattr(self.local, "cert", None)
+        self._stack().append(record)
+        started = time.monotonic()
+        try:
+            yield record
+        finally:
+            self._stack().pop()
+            record["seconds"] = round(time.monotonic() - started, 6)
+            record["backoff"] = round(record["backoff"], 6)
+            with self.lock:
+                histogram = self._observe((phase, name), record["seconds"])
+                histogram["retries"] += record["retries"]
+                histogram["backoff"] += record["backoff"]
+                if cert is None:
+                    self.unbound.append(record)
+                else:
+                    record["start"] = round(started - cert["monotonic"], 6)
+                    cert["spans"].append(record)
+
+    def retry(self):
+        """Count a retry against the innermost open span."""
+        if self._stack():
+            self._stack()[-1]["retries"] += 1
+
+    def backoff(self, seconds, retries=1):
+        """Count retries and time spent waiting for them against the innermost open span."""
+        if self._stack():
+            self._stack()[-1]["retries"] += retries
+            self._stack()[-1]["backoff"] += seconds
+
+    def sleep(self, seconds):
+        """time.sleep(), counted as a retry and backoff of the innermost open span."""
+        self.backoff(seconds)
+        time.sleep(seconds)
+
+    @contextlib.contextmanager
+    def bind(self, cert_name):
+        """Attribute the spans of this thread to cert_name for a while."""
+        with self.lock:
+            cert = self.certs.setdefault(cert_name, {
+                "cert": cert_name, "started": time.time(), "monotonic": time.monotonic(),
+                "spans": []})
+        previous = getattr(self.local, "cert", None)
+        self.local.cert = cert
+        try:
+            yield cert
+        finally:
+            self.local.cert = previous
+
+    def wrap(self, func):
+        """func, run with the calling thread's certificate bound; for executor threads."""
+        cert = getattr(self.local, "cert", None)
+        if cert is None:
+            return func
+
+        def bound(*args, **kwargs):
+            with self.bind(cert["cert"]):
+                return func(*args, **kwargs)
+        return bound
+
+    def finish(self, cert_name, error=None):
+        """Close a certificate's record and write its JSON line."""
+        with self.lock:
+            cert = self.certs.pop(cert_name, None)
+            if cert is None:
+                return
+            seconds = time.monotonic() - cert.pop("monotonic")
+            result = "ok" if error is None else "failed"
+            self._observe(("certificate", result), seconds)
+            self.results[result] = self.results.get(result, 0) + 1
+            cert.update(ok=error is None, seconds=round(seconds, 6),
+                        error=None if error is None else str(error))
+            if self.jsonl_file:
+                with open(self.jsonl_file, "a") as jsonl:
+                    jsonl.write(json.dumps(cert) + "\n")
+
+    @contextlib.contextmanager
+    def certificate(self, cert_name):
+        """bind() cert_name and finish() its record at the end, failed on an exception."""
+        with self.bind(cert_name):
+            try:
+                yield
+            except BaseException as error:
+                self.finish(cert_name, error)
+                raise
+        self.finish(cert_name)
+
+    def flush_unbound(self):
+        """Write spans not tied to a single certificate (e.g. shared waits) as one line."""
+        with self.lock:
+            unbound, self.unbound = self.unbound, []
+            if self.jsonl_file and unbound:
+                with open(self.jsonl_file, "a") as jsonl:
+                    jsonl.write(json.dumps({"cert": None, "started": start.timestamp(),
+                                            "spans": unbound}) + "\n")
+
+    def prometheus(self):
+        """The aggregated metrics in the Prometheus text exposition format."""
+        def labels(phase, name, extra=""):
+            return 'phase="{0}",name="{1}"{2}'.format(phase, name, extra)
+
+        lines = ["# HELP acme_certs_span_seconds Time spent in each phase and external call.",
+                 "# TYPE acme_certs_span_seconds histogram"]
+        counters = ["# HELP acme_certs_span_retries_total Retries within each span.",
+                    "# TYPE acme_certs_span_retries_total counter"]
+        backoffs = ["# HELP acme_certs_span_backoff_seconds_total Time slept before retries.",
+                    "# TYPE acme_certs_span_backoff_seconds_total counter"]
+        with self.lock:
+            spans = copy.deepcopy(self.spans)
+            results = dict(self.results)
+        for (phase, name), histogram in sorted(spans.items()):
+            for bound, count in zip(self.BUCKETS, histogram["buckets"]):
+                lines.append("acme_certs_span_seconds_bucket{%s} %d"
+                             % (labels(phase, name, f',le="{bound}"'), count))
+            lines.append("acme_certs_span_seconds_bucket{%s} %d"
+                         % (labels(phase, name, ',le="+Inf"'), histogram["count"]))
+            lines.append("acme_certs_span_seconds_sum{%s} %f"
+                         % (labels(phase, name), histogram["sum"]))
+            lines.append("acme_certs_span_seconds_count{%s} %d"
+                         % (labels(phase, name), histogram["count"]))
+            counters.append("acme_certs_span_retries_total{%s} %d"
+                            % (labels(phase, name), histogram["retries"]))
+            backoffs.append("acme_certs_span_backoff_seconds_total{%s} %f"
+                            % (labels(phase, name), histogram["backoff"]))
+        lines += counters + backoffs
+        lines += ["# HELP acme_certs_certificates_total Certificates attempted, by result.",
+                  "# TYPE acme_certs_certificates_total counter"]
+        lines += ['acme_certs_certificates_total{result="%s"} %d' % (result, count)
+                  for result, count in sorted(results.items())]
+        lines += ["# HELP acme_certs_last_run_timestamp_seconds When these metrics were written.",
+                  "# TYPE acme_certs_last_run_timestamp_seconds gauge",
+                  "acme_certs_last_run_timestamp_seconds %f" % time.time()]
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path):
+        """Write prometheus() to path atomically, e.g. for node_exporter's textfile collector."""
+        _atomic_write(path, self.prometheus())
+
+
+METRICS = Metrics()
+
+
+class AccountKey:
+    """ACME account key loaded once and used to sign requests in-process.
+
+    RSA keys sign with RS256 and P-256 EC keys with ES256.
+    """
+
+    def __init__(self, key_file):
+        with open(key_file, "rb") as key_pem:
+            self.key = serialization.load_pem_private_key(key_pem.read(), password=None)
+        if isinstance(self.key, rsa.RSAPrivateKey):
+            numbers = self.key.public_key().public_numbers()
+            self.alg = "RS256"
+            self.jwk = {"e": _base64(_int_bytes(numbers.e)), "kty": "RSA",
+                        "n": _base64(_int_bytes(numbers.n))}
+        elif (isinstance(self.key, ec.EllipticCurvePrivateKey)
+              and isinstance(self.key.curve, ec.SECP256R1)):
+            numbers = self.key.public_key().public_numbers()
+            self.alg = "ES256"
+            self.jwk = {"crv": "P-256", "kty": "EC",
+                        "x": _base64(_int_bytes(numbers.x, 32)),
+                        "y": _base64(_int_bytes(numbers.y, 32))}
         else:
-            chal_domain=split_domain[0]+"."+split_domain[1]
-            base_domain=split_domain[2]
-        api_url = f'{do_base}domains/{base_domain}/records'
-        txt_params = {'type' : 'TXT', 'name' : f'{chal_domain}',
-            'data' : f'{keydigest64}', 'ttl' : 1800}
-        backoff = 1
+            raise ValueError("Account key {0} is neither RSA nor P-256 EC.".format(key_file))
+
+    def sign(self, data):
+        """Sign data, returning the raw JWS signature."""
+        if self.alg == "RS256":
+            return self.key.sign(data, padding.PKCS1v15(), hashes.SHA256())
+        r, s = utils.decode_dss_signature(self.key.sign(data, ec.ECDSA(hashes.SHA256())))
+        return _int_bytes(r, 32) + _int_bytes(s, 32)
+
+
+class OpensslAccountKey:
+    """RSA account key that signs each request with the openssl command line."""
+
+    def __init__(self, key_file):
+        self.key_file = key_file
+        accountkey = _openssl("rsa", ["-in", key_file, "-noout", "-text"])
+        signature_search = re.search(r"modulus:\s+?00:([a-f0-9\:\s]+?)\r?\npublicExponent: ([0-9]+)",
+                                     accountkey.decode("utf8"), re.MULTILINE)
+        if signature_search is None:
+            raise ValueError("Unable to retrieve private signature.")
+        pub_hex, pub_exp = signature_search.groups()
+        pub_exp = "{0:x}".format(int(pub_exp))
+        pub_exp = "0{0}".format(pub_exp) if len(pub_exp) % 2 else pub_exp
+        self.alg = "RS256"
+        self.jwk = {
+            "e": _base64(binascii.unhexlify(pub_exp.encode("utf-8"))),
+            "kty": "RSA",
+            "n": _base64(binascii.unhexlify(re.sub(r"(\s|:)", "", pub_hex).encode("utf-8"))),
+        }
+
+    def sign(self, data):
+        """Sign data, returning the raw JWS signature."""
+        return _openssl("dgst", ["-sha256", "-sign", self.key_file], data)
+
+
+def load_account_key(key_file, signer="auto"):
+    """Load key_file for in-process signing, or with openssl if asked or unavailable."""
+    if signer == "openssl" or x509 is None:
+        return OpensslAccountKey(key_file)
+    return AccountKey(key_file)
+
+
+def read_csr(csr_file, signer="auto"):
+    """Return the set of domains named in a PEM CSR and its DER encoding."""
+    domains = set()
+    if signer == "openssl" or x509 is None:
+        csr = _openssl("req", ["-in", csr_file, "-noout", "-text"]).decode("utf8")
+        common_name = re.search(r"Subject:.*?\s+?CN\s*?=\s*?([^\s,;/]+)", csr)
+        if common_name is not None:
+            domains.add(common_name.group(1))
+        subject_alt_names = re.search(
+            r"X509v3 Subject Alternative Name: (?:critical)?\s+([^\r\n]+)\r?\n",
+            csr, re.MULTILINE)
+        if subject_alt_names is not None:
+            for san in subject_alt_names.group(1).split(", "):
+                if san.startswith("DNS:"):
+                    domains.add(san[4:])
+        csr_der = _openssl("req", ["-in", csr_file, "-outform", "DER"])
+    else:
+        with open(csr_file, "rb") as csr_pem:
+            csr = x509.load_pem_x509_csr(csr_pem.read())
+        domains.update(attribute.value for attribute
+                       in csr.subject.get_attributes_for_oid(NameOID.COMMON_NAME))
+        try:
+            subject_alt_names = csr.extensions.get_extension_for_class(x509.SubjectAlternativeName)
+            domains.update(subject_alt_names.value.get_values_for_type(x509.DNSName))
+        except x509.ExtensionNotFound:
+            pass
+        csr_der = csr.public_bytes(serialization.Encoding.DER)
+    if len(domains) == 0:  # pylint: disable=len-as-condition
+        raise ValueError("Didn't find any domain to validate in the provided CSR.")
+    return domains, csr_der
+
+
+def read_cert(cert_file, signer="auto"):
+    """Return the notAfter (seconds since the epoch) and ARI certID of a PEM certificate.
+
+    The certID is None when it can't be worked out, e.g. without the
+    cryptography package or for a certificate without an Authority Key
+    Identifier.
+    """
+    if signer == "openssl" or x509 is None:
+        end_date = _openssl("x509", ["-in", cert_file, "-noout", "-enddate"]).decode("utf8")
+        return calendar.timegm(time.strptime(end_date.strip().split("=", 1)[1],
+                                             "%b %d %H:%M:%S %Y %Z")), None
+    with open(cert_file, "rb") as cert_pem:
+        cert = x509.load_pem_x509_certificate(cert_pem.read())
+    not_after = getattr(cert, "not_valid_after_utc", None) or cert.not_valid_after
+    try:
+        key_id = cert.extensions.get_extension_for_class(
+            x509.AuthorityKeyIdentifier).value.key_identifier
+        cert_id = "{0}.{1}".format(
+            _base64(key_id),
+            _base64(cert.serial_number.to_bytes(cert.serial_number.bit_length() // 8 + 1, "big")))
+    except x509.ExtensionNotFound:
+        cert_id = None
+    return calendar.timegm(not_after.utctimetuple()), cert_id
+
+
+def _renews(csr_file):
+    """Whether a certificate is already stored for the names of csr_file, so ordering renews it.
+
+    The files this script writes next to a CSR are named after the same
+    names (a pack after a digest of them), so no certificate needs reading.
+    """
+    if not csr_file.endswith(".csr"):
+        return False
+    return any(os.path.exists(csr_file[:-len(".csr")] + suffix)
+               for suffix in (".cert.pem", ".fullchain.pem"))
+
+
+class AcmeExit(Exception):
+    """A single certificate failed with one of the exit codes listed above."""
+
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+
+class RateLimited(AcmeExit):
+    """The CA answered with a rate limit, or its budget is used up."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(6, message)
+        self.retry_after = retry_after
+
+
+class LeaseLost(AcmeExit):
+    """Another worker took over the lease of the certificate being ordered."""
+
+    def __init__(self, message):
+        super().__init__(5, message)
+
+
+def _http_session(pool_size=10, headers=None):
+    """Return a requests Session keeping up to pool_size connections alive per host."""
+    http = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+    http.mount("https://", adapter)
+    http.mount("http://", adapter)
+    http.headers.update(headers or {})
+    return http
+
+
+def _connection_stats(http):
+    """Count the connections opened and requests sent through a requests Session."""
+    connections = requests_sent = 0
+    for adapter in set(http.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools[key]
+            connections += pool.num_connections
+            requests_sent += pool.num_requests
+    return {"connections": connections, "requests": requests_sent}
+
+
+def _error_type(response):
+    """ACME problem type of an error response without its URN prefix, or ''."""
+    try:
+        return response.json().get("type", "").rsplit(":", 1)[-1]
+    except (ValueError, AttributeError):
+        return ""
+
+
+def _retry_after(response):
+    """Seconds to wait from a Retry-After header (seconds or HTTP-date), or None."""
+    value = response.headers.get("Retry-After") if response is not None else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(email.utils.parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+
+class PollScheduler:
+    """Polls every outstanding ACME challenge and order from one thread.
+
+    schedule() queues a check, returning a Future. Checks sit in a heap
+    keyed by when they are next due. A check returns (result, delay); a
+    result other than None completes its Future, otherwise it is checked
+    again after delay seconds, as the server asked with Retry-After. When
+    no delay was given, the interval starts at interval seconds and grows
+    by half each time up to max_interval. A check that raises, or is still
+    not done at its deadline, fails its Future.
+
+    Checks due within coalesce seconds of each other are run in the same
+    wakeup, on a few threads. No more than max_rate checks a second are
+    started on average, with bursts of up to a second's worth, however
+    many orders are waiting.
+    """
+
+    def __init__(self, max_rate=20.0, interval=1.0, max_interval=30.0, coalesce=0.05,
+                 workers=8):
+        self.max_rate = max_rate
+        self.interval = interval
+        self.max_interval = max_interval
+        self.coalesce = coalesce
+        self.workers = workers
+        self.queue = []
+        self.order = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.closed = False
+        self.tokens = max_rate
+        self.refilled = time.monotonic()
+        self.polls = 0
+
+    def schedule(self, check, delay=None, timeout=300.0, on_timeout=None):
+        """Queue check() to be called in delay seconds, then until done; returns a Future.
+
+        on_timeout() makes the exception the Future fails with at the
+        deadline, by default a TimeoutError. Cancelling the Future stops
+        the polling.
+        """
+        now = time.monotonic()
+        entry = {"check": METRICS.wrap(check), "future": Future(), "deadline": now + timeout,
+                 "interval": self.interval, "on_timeout": on_timeout, "started": now,
+                 "polls": 0}
+        with self.condition:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="acme-poller", daemon=True)
+                self.thread.start()
+            heapq.heappush(self.queue, (now + (self.interval if delay is None else delay),
+                                        next(self.order), entry))
+            self.condition.notify()
+        return entry["future"]
+
+    def wait(self, check, delay=None, timeout=300.0, on_timeout=None):
+        """schedule() and wait for the result."""
+        return self.result(self.schedule(check, delay, timeout, on_timeout))
+
+    @staticmethod
+    def result(future):
+        """A scheduled check's result, the wait counted as the current span's backoff."""
+        started = time.monotonic()
+        try:
+            return future.result()
+        finally:
+            METRICS.backoff(time.monotonic() - started, 0)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+
+    def _due(self):
+        """Wait for the next checks to come due and take them off the heap."""
+        with self.condition:
+            while not self.closed:
+                now = time.monotonic()
+                if self.queue and self.queue[0][0] <= now:
+                    due = []
+                    while self.queue and self.queue[0][0] <= now + self.coalesce:
+                        due.append(heapq.heappop(self.queue)[2])
+                    return due
+                self.condition.wait(self.queue[0][0] - now if self.queue else None)
+            return []
+
+    def _run(self):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while True:
+                due = self._due()
+                if not due:
+                    return
+                for entry in due:
+                    self._take_token()
+                    executor.submit(self._check, entry)
+
+    def _take_token(self):
+        """Wait for the token bucket holding max_rate checks to have one to spare."""
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.tokens + (now - self.refilled) * self.max_rate, self.max_rate)
+            self.refilled = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            time.sleep((1 - self.tokens) / self.max_rate)
+
+    def _check(self, entry):
+        if entry["future"].cancelled():
+            return
+        entry["polls"] += 1
+        with self.condition:
+            self.polls += 1
+        try:
+            result, delay = entry["check"]()
+        except Exception as error:  # pylint: disable=broad-except
+            entry["future"].set_exception(error)
+            return
+        if result is not None:
+            entry["future"].set_result(result)
+            return
+        if delay is None:
+            delay = entry["interval"]
+            entry["interval"] = min(entry["interval"] * 1.5, self.max_interval)
+        now = time.monotonic()
+        if now >= entry["deadline"]:
+            entry["future"].set_exception(
+                entry["on_timeout"]() if entry["on_timeout"]
+                else TimeoutError(f"Still not done after {entry['polls']} polls"))
+            return
+        with self.condition:
+            heapq.heappush(self.queue, (min(now + delay, entry["deadline"]), next(self.order),
+                                        entry))
+            self.condition.notify()
+
+
+class NoncePool:
+    """Thread-safe stock of unused Replay-Nonces for one ACME server.
+
+    Every response hands its fresh nonce back with put(), so a run only asks
+    newNonce for one when the pool is empty. Only the newest nonces are
+    kept because the server may expire old ones.
+    """
+
+    def __init__(self, http, url, maxsize=16):
+        self.http = http
+        self.url = url
+        self.maxsize = maxsize
+        self.nonces = []
+        self.lock = threading.Lock()
+        self.fetched = 0
+        self.rejected = 0
+
+    def fetch(self):
+        """Get a fresh nonce from the server's newNonce URL."""
+        with self.lock:
+            self.fetched += 1
+        with METRICS.span("acme", "newNonce"):
+            return self.http.head(self.url).headers['Replay-Nonce']
+
+    def fill(self, count):
+        """Prefetch nonces until the pool holds count of them."""
+        while len(self.nonces) < min(count, self.maxsize):
+            self.put(self.fetch())
+
+    def get(self):
+        with self.lock:
+            if self.nonces:
+                return self.nonces.pop()
+        return self.fetch()
+
+    def put(self, nonce):
+        with self.lock:
+            self.nonces.append(nonce)
+            del self.nonces[:-self.maxsize]
+
+    def reject(self):
+        """Count a nonce the server turned down with badNonce."""
+        with self.lock:
+            self.rejected += 1
+
+
+def _host_port(server, default_port=53):
+    """Split 'host[:port]' into (host, port)."""
+    if server.count(":") == 1:
+        host, port = server.split(":")
+        return host, int(port)
+    return server, default_port
+
+
+class PropagationChecker:
+    """Wait until TXT records are served by every authoritative nameserver.
+
+    Each poll queries every nameserver of a record's zone directly and in
+    parallel, rather than going through the local recursive resolver. A
+    nameserver that doesn't answer in time is left out of that poll rather
+    than counted as serving the wrong value, so a record counts once at
+    least one of them answers and every one that answers returns its exact
+    value. Only the address families this host has a route for are asked,
+    so IPv6 nameserver addresses are skipped on an IPv4-only host. Polls
+    start interval seconds apart and back off gently to max_interval until
+    timeout. Records for many names are checked together in one pass; a name
+    with several values, such as a wildcard and its base domain validated
+    together, counts once all of them are served.
+    """
+
+    def __init__(self, nameservers=None, timeout=310, interval=2, max_interval=20,
+                 query_timeout=3):
+        self.nameservers = [_host_port(server) for server in nameservers or []]
+        self.timeout = timeout
+        self.interval = interval
+        self.max_interval = max_interval
+        self.query_timeout = query_timeout
+        self.resolver = dns.resolver.Resolver()
+        self.zone_servers = {}
+        self.families = None
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=16)
+
+    @staticmethod
+    def _routable(family, address):
+        """Whether this host has a route to address; connecting UDP sends nothing."""
+        try:
+            with socket.socket(family, socket.SOCK_DGRAM) as probe:
+                probe.connect((address, 53))
+            return True
+        except OSError:
+            return False
+
+    def rdtypes(self):
+        """Address record types for the families this host can reach nameservers over."""
+        if self.families is None:
+            self.families = [rdtype for rdtype, family, address
+                             in (('A', socket.AF_INET, '192.0.2.1'),
+                                 ('AAAA', socket.AF_INET6, '2001:db8::1'))
+                             if self._routable(family, address)] or ['A', 'AAAA']
+        return self.families
+
+    def servers(self, name):
+        """(address, port) of each authoritative nameserver for name's zone."""
+        if self.nameservers:
+            return self.nameservers
+        zone = dns.resolver.zone_for_name(name, resolver=self.resolver)
+        with self.lock:
+            if zone in self.zone_servers:
+                return self.zone_servers[zone]
+        addresses = []
+        for nameserver in self.resolver.resolve(zone, 'NS'):
+            for rdtype in self.rdtypes():
+                try:
+                    addresses += [(address.address, 53) for address
+                                  in self.resolver.resolve(nameserver.target, rdtype)]
+                except dns.exception.DNSException:
+                    pass
+        if not addresses:
+            raise dns.exception.DNSException(f'No nameserver addresses found for {zone}')
+        with self.lock:
+            self.zone_servers[zone] = addresses
+        return addresses
+
+    def query(self, server, name):
+        """TXT values served for name by one nameserver, or None if it didn't answer."""
+        address, port = server
+        request = dns.message.make_query(name, 'TXT')
+        try:
+            with METRICS.span("dns_query", "TXT"):
+                response = dns.query.udp(request, address, timeout=self.query_timeout, port=port)
+                if response.flags & dns.flags.TC:
+                    METRICS.retry()
+                    response = dns.query.tcp(request, address, timeout=self.query_timeout,
+                                             port=port)
+        except (dns.exception.DNSException, OSError):
+            return None
+        return {b"".join(rdata.strings).decode("utf8")
+                for rrset in response.answer if rrset.rdtype == dns.rdatatype.TXT
+                for rdata in rrset}
+
+    def wait(self, records, log=LOGGER):
+        """Wait until every {name: values} in records is served by each nameserver."""
+        missing = self.missing(records, log)
+        if missing:
+            log.warning('Waited too long for DNS')
+            raise AcmeExit(3, 'Waited too long for DNS propagation of {0}'
+                           .format(', '.join(sorted(missing))))
+
+    def missing(self, records, log=LOGGER):
+        """Poll until records are served everywhere or time runs out.
+
+        Returns the set of names still not propagated at the deadline.
+        """
+        pending = {name: set(values) for name, values in records.items()}
+        deadline = time.monotonic() + self.timeout
+        interval = self.interval
+        while True:
+            checks = []
+            for name in pending:
+                try:
+                    servers = self.servers(name)
+                except dns.exception.DNSException as error:
+                    log.info(error)
+                    continue
+                checks += [(name, self.executor.submit(METRICS.wrap(self.query), server, name))
+                           for server in servers]
+            found = set()
+            stale = set()
+            for name, check in checks:
+                values = check.result()
+                if values is not None:
+                    (found if pending[name] <= values else stale).add(name)
+            for name in found - stale:
+                log.info(f'TXT record found for {name} on every authoritative nameserver '
+                         f'that answered')
+                del pending[name]
+            remaining = deadline - time.monotonic()
+            if not pending or remaining <= 0:
+                return set(pending)
+            log.info(f'Waiting {interval:.0f}s for {len(pending)} TXT record(s)')
+            METRICS.sleep(min(interval, remaining))
+            interval = min(interval * 1.5, self.max_interval)
+
+
+class DNSProvider(abc.ABC):
+    """Where the dns-01 TXT records get created and deleted.
+
+    Subclasses implement the abstract methods to list the account's zones and create, delete and list records
+    within a single zone. This class maps record names to their zone by
+    longest suffix match against the (cached) zone list, and splits work
+    into one batch per zone, with the zones handled concurrently.
+
+    A record created here is identified by a (zone, record_id) handle.
+    """
+
+    name = "dns"
+    CHALLENGE_PREFIX = "_acme-challenge."
+
+    def __init__(self, jobs=4):
+        self.jobs = jobs
+        self.zone_list = None
+        self.zone_lock = threading.Lock()
+
+    @abc.abstractmethod
+    def list_zones(self, log):
+        """Names of the zones the account can create records in."""
+
+    @abc.abstractmethod
+    def create_zone_records(self, zone, records, log):
+        """Create [(fqdn, value)] in zone, returning (record_id, error) for each."""
+
+    @abc.abstractmethod
+    def delete_zone_records(self, zone, record_ids, log):
+        """Delete record ids from zone, returning the ones that couldn't be."""
+
+    @abc.abstractmethod
+    def challenge_records(self, zone, log):
+        """[(record_id, fqdn)] of the _acme-challenge TXT records in zone."""
+
+    def zones(self, log=LOGGER):
+        with self.zone_lock:
+            if self.zone_list is None:
+                self.zone_list = sorted(self.list_zones(log), key=len, reverse=True)
+                log.info(f"{self.name} has {len(self.zone_list)} zones")
+            return self.zone_list
+
+    def zone_for(self, fqdn, log=LOGGER):
+        for zone in self.zones(log):
+            if fqdn == zone or fqdn.endswith("." + zone):
+                return zone
+        raise AcmeExit(2, f"No {self.name} zone found for {fqdn}")
+
+    def _per_zone(self, func, batches):
+        """Run func(zone, items) for every zone, returning {zone: (result, error)}."""
+        if len(batches) == 1:
+            zone, items = next(iter(batches.items()))
+            try:
+                return {zone: (func(zone, items), None)}
+            except Exception as error:  # pylint: disable=broad-except
+                return {zone: (None, error)}
+        with ThreadPoolExecutor(max_workers=min(self.jobs, len(batches))) as executor:
+            futures = {zone: executor.submit(METRICS.wrap(func), zone, items)
+                       for zone, items in batches.items()}
+        outcomes = {}
+        for zone, future in futures.items():
+            try:
+                outcomes[zone] = (future.result(), None)
+            except Exception as error:  # pylint: disable=broad-except
+                outcomes[zone] = (None, error)
+        return outcomes
+
+    def create_records(self, records, log=LOGGER):
+        """Create TXT records [(fqdn, value)], returning [(handle, error)] in the same order.
+
+        Each record is created or fails on its own, so a request that fails
+        only fails the orders whose record it was; a zone's batch only
+        fails as a whole when the zone can't be worked on at all.
+        """
+        batches = {}
+        outcomes = [None] * len(records)
+        for index, (fqdn, value) in enumerate(records):
+            try:
+                batches.setdefault(self.zone_for(fqdn, log), []).append((index, fqdn, value))
+            except AcmeExit as error:
+                outcomes[index] = (None, error)
+        with METRICS.span("dns_create"):
+            results = self._per_zone(
+                lambda zone, items: self.create_zone_records(zone, [item[1:] for item in items],
+                                                             log),
+                batches)
+        for zone, items in batches.items():
+            created, zone_error = results[zone]
+            for number, (index, fqdn, _) in enumerate(items):
+                record_id, error = (None, zone_error) if zone_error else created[number]
+                if error is None:
+                    log.info(f"Created TXT record {fqdn} ID: {record_id}")
+                    outcomes[index] = ((zone, record_id), None)
+                else:
+                    if not isinstance(error, AcmeExit):
+                        error = AcmeExit(2, f"Adding TXT record {fqdn} in {zone} failed: {error}")
+                    outcomes[index] = (None, error)
+        return outcomes
+
+    def delete_records(self, handles, log=LOGGER):
+        """Delete records by handle, zone by zone, returning the handles left behind."""
+        batches = {}
+        for zone, record_id in handles:
+            batches.setdefault(zone, []).append(record_id)
+        left = []
+        with METRICS.span("dns_delete"):
+            results = self._per_zone(
+                lambda zone, record_ids: self.delete_zone_records(zone, record_ids, log), batches)
+        for zone, (failed, error) in results.items():
+            failed = batches[zone] if error is not None else failed
+            left += [(zone, record_id) for record_id in failed]
+        if left:
+            log.warning(f"Could not delete {len(left)} TXT record(s), "
+                        f"leaving them for --sweep: {left}")
+        else:
+            log.info(f"Deleted {len(handles)} TXT record(s)")
+        return left
+
+    def sweep(self, keep=(), log=LOGGER):
+        """Delete every _acme-challenge TXT record in every zone except the handles in keep.
+
+        Returns how many records were deleted. Only run it when nothing else
+        is validating against these zones, since their records go too.
+        """
+        batches = {}
+        for zone, (records, error) in self._per_zone(
+                lambda zone, _: self.challenge_records(zone, log),
+                {zone: None for zone in self.zones(log)}).items():
+            if error is not None:
+                log.warning(f"Could not list records of {zone}: {error}")
+                continue
+            for record_id, fqdn in records:
+                if (zone, record_id) not in keep:
+                    log.debug(f"Sweeping {fqdn} ({record_id})")
+                    batches.setdefault(zone, []).append((zone, record_id))
+        handles = [handle for zone_handles in batches.values() for handle in zone_handles]
+        if not handles:
+            log.info("No _acme-challenge TXT records to sweep")
+            return 0
+        log.info(f"Sweeping {len(handles)} _acme-challenge TXT record(s) "
+                 f"from {len(batches)} zone(s)")
+        return len(handles) - len(self.delete_records(handles, log))
+
+
+class DigitalOceanProvider(DNSProvider):
+    """DNS records through the DigitalOcean v2 API.
+
+    The API has no bulk record endpoint, so a zone's batch is sent one
+    request after the other over a kept-alive connection, which also keeps
+    clear of the per-minute rate limit, and each record succeeds or fails
+    on its own. 429 and 5xx responses are retried
+    after Retry-After, or until RateLimit-Reset once RateLimit-Remaining
+    hits 0, or else with a doubling backoff.
+    """
+
+    name = "digitalocean"
+    RETRIES = 6
+    TTL = 1800
+    PAGE = 200
+
+    def __init__(self, http, base=None, jobs=4):
+        super().__init__(jobs)
+        self.http = http
+        self.base = base or do_base
+
+    @staticmethod
+    def _retry_delay(response, attempt):
+        backoff = min(2 ** (attempt + 1), 64)
+        if response is None:
+            return backoff
+        try:
+            return max(float(response.headers["Retry-After"]), 0)
+        except (KeyError, ValueError):
+            pass
+        if response.headers.get("RateLimit-Remaining") == "0":
+            try:
+                return min(max(float(response.headers["RateLimit-Reset"]) - time.time(), 0) + 1,
+                           600)
+            except (KeyError, ValueError):
+                pass
+        return backoff
+
+    def _request(self, method, path, log, **kwargs):
+        """Send an API request, retrying connection errors, 429 and 5xx responses."""
+        with METRICS.span("dns_api", method):
+            for attempt in range(self.RETRIES + 1):
+                response = None
+                try:
+                    response = self.http.request(method, self.base + path, **kwargs)
+                    if response.status_code != 429 and response.status_code < 500:
+                        return response
+                    failure = f"{response.status_code} {response.text[:200]}"
+                except requests.exceptions.RequestException as error:
+                    failure = str(error)
+                if attempt == self.RETRIES:
+                    break
+                delay = self._retry_delay(response, attempt)
+                log.info(f"DigitalOcean {method} {path} failed ({failure}), "
+                         f"retrying in {delay:.0f}s")
+                METRICS.sleep(delay)
+        raise IOError(f"DigitalOcean {method} {path} failed after {self.RETRIES} retries: "
+                      f"{failure}")
+
+    def _pages(self, path, key, log):
+        """Every item of a paginated listing."""
+        items, page = [], 1
         while True:
-            backoff = backoff * 2
+            response = self._request("GET", path, log, params={"per_page": self.PAGE, "page": page})
+            if response.status_code != 200:
+                raise IOError(f"DigitalOcean GET {path} failed: "
+                              f"{response.status_code} {response.text[:200]}")
+            listing = response.json()
+            items += listing[key]
+            if not listing.get("links", {}).get("pages", {}).get("next"):
+                return items
+            page += 1
+
+    def list_zones(self, log):
+        return [domain["name"] for domain in self._pages("domains", "domains", log)]
+
+    def create_zone_records(self, zone, records, log):
+        created = []
+        for fqdn, value in records:
+            txt_params = {'type': 'TXT', 'name': fqdn[:-len(zone) - 1] or '@',
+                          'data': value, 'ttl': self.TTL}
             try:
-                txt_add = requests.post(api_url, headers=do_headers, json=txt_params)
-            except requests.exceptions.RequestException as error:
-                txt_add = error.response
-            if backoff > 64:
-                log.warning(f'Adding TXT record failed after many retires\n{txt_add.text}')
-                sys.exit(2)
-            else:
+                txt_add = self._request("POST", f"domains/{zone}/records", log, json=txt_params)
                 try:
-                    txt_id=txt_add.json()['domain_record']['id']
-                    log.info(f'Created TXT record ID: {txt_id}')
-                    return(txt_id)
-                except KeyError: # API hasn't generated a record
-                    log.info(f"Bad response from DO API server, retrying in {backoff}s")
-                    log.info(f"{txt_add}")
-                    time.sleep(backoff)
-                except ValueError:  # if body is empty or not JSON formatted
-                    log.info(f"No response from DO API server, retrying in {backoff}s")
-                    time.sleep(backoff)
+                    created.append((txt_add.json()['domain_record']['id'], None))
+                except (KeyError, TypeError, ValueError):
+                    raise IOError(f"Bad response from DO API server: "
+                                  f"{txt_add.status_code} {txt_add.text[:200]}")
+            except IOError as error:
+                created.append((None, error))
+        return created
 
-    def test_txt(domain):
-        log.info(f'Testing TXT record for {domain}')
-        txt_propagated='false'
-        wait_time=10
-        dns_resolver=dns.resolver.Resolver()
-        while txt_propagated == 'false':
+    def delete_zone_records(self, zone, record_ids, log):
+        failed = []
+        for record_id in record_ids:
             try:
-                dnslookup = dns_resolver.resolve(f'{domain}', 'TXT')
-            except Exception as e:
-                log.info(e)
-                dnslookup = ''
-            if len(dnslookup):
-                log.info(f'TXT record found: {dnslookup}')
-                txt_propagated='true'
-            else:
-                log.info(f'Waiting for {wait_time}')
-                time.sleep(wait_time)
-                wait_time=wait_time*2
-                if wait_time > 320:
-                    log.warning('Waited too long for DNS')
-                    sys.exit(3)
-
-    def delete_txt(txt_id,domain):
-        split_domain=domain.split(".",2)
-        if rootdomain:
-            base_domain=split_domain[1]+"."+split_domain[2]
+                response = self._request("DELETE", f"domains/{zone}/records/{record_id}", log)
+                if response.status_code not in (204, 404):
+                    raise IOError(f"{response.status_code} {response.text[:200]}")
+            except IOError as error:
+                log.info(f"Deleting TXT record {record_id} in {zone} failed: {error}")
+                failed.append(record_id)
+        return failed
+
+    def challenge_records(self, zone, log):
+        prefix = self.CHALLENGE_PREFIX.rstrip(".")
+        return [(record["id"], f'{record["name"]}.{zone}')
+                for record in self._pages(f"domains/{zone}/records?type=TXT",
+                                          "domain_records", log)
+                if record["type"] == "TXT"
+                and (record["name"] == prefix or record["name"].startswith(prefix + "."))]
+
+
+class StubProvider(DNSProvider):
+    """DNS records kept in memory, or in a JSON file for tests and benchmarks.
+
+    The file maps each zone to its records, {zone: {record_id: [fqdn, value]}},
+    so a local DNS stub can serve them. It is locked while being updated,
+    which lets several runs share one file. Kept in memory without any
+    zones given, it takes the last two labels of every name as its zone.
+    """
+
+    name = "stub"
+
+    def __init__(self, path=None, zones=(), jobs=4):
+        super().__init__(jobs)
+        self.path = path
+        self.data = {zone: {} for zone in zones}
+        self.lock = threading.Lock()
+
+    def _update(self, func):
+        """Apply func to the records, under both the thread and the file lock."""
+        with self.lock:
+            if self.path is None:
+                return func(self.data)
+            with _update_json(self.path) as data:
+                # A file not written yet starts from the zones given
+                data.update(data or self.data)
+                result = func(data)
+            self.data = data
+            return result
+
+    def _read(self):
+        """A snapshot of the records."""
+        with self.lock:
+            if self.path is not None:
+                with _file_lock(self.path, shared=True):
+                    self.data = _read_json(self.path) or self.data
+            return copy.deepcopy(self.data)
+
+    def list_zones(self, log):
+        return list(self._read())
+
+    def zone_for(self, fqdn, log=LOGGER):
+        if self.path is None and not self.zones(log):
+            return ".".join(fqdn.split(".")[-2:])
+        return super().zone_for(fqdn, log)
+
+    def create_zone_records(self, zone, records, log):
+        def create(data):
+            created = []
+            for fqdn, value in records:
+                record_id = binascii.hexlify(os.urandom(8)).decode()
+                data.setdefault(zone, {})[record_id] = [fqdn, value]
+                created.append((record_id, None))
+            return created
+        return self._update(create)
+
+    def delete_zone_records(self, zone, record_ids, log):
+        def delete(data):
+            for record_id in record_ids:
+                data.get(zone, {}).pop(record_id, None)
+            return []
+        return self._update(delete)
+
+    def challenge_records(self, zone, log):
+        return [(record_id, fqdn) for record_id, (fqdn, _) in self._read().get(zone, {}).items()
+                if fqdn.startswith(self.CHALLENGE_PREFIX)]
+
+    def lookup(self, fqdn):
+        """Values of the TXT records named fqdn."""
+        return [value for records in self._read().values()
+                for name, value in records.values() if name == fqdn]
+
+
+def dns_provider(spec, jobs=10):
+    """The DNS provider named by spec: 'digitalocean[:API_URL]' or 'stub[:FILE]'."""
+    name, _, path = spec.partition(":")
+    if name == "digitalocean":
+        return DigitalOceanProvider(_http_session(jobs, do_headers), path or None,
+                                    jobs=min(jobs, 4))
+    if name == "stub":
+        return StubProvider(path or None, jobs=min(jobs, 4))
+    raise ValueError(f"Unknown DNS provider {spec}")
+
+
+def _rfc3339_epoch(value):
+    """Seconds since the epoch of an RFC 3339 UTC timestamp such as an ACME expires."""
+    return calendar.timegm(time.strptime(value[:19], "%Y-%m-%dT%H:%M:%S"))
+
+
+class AccountCache:
+    """On-disk cache of ACME directory, account and authorization state.
+
+    Entries are keyed by directory URL and account key thumbprint, so one
+    file serves every CA and account key. The directory document expires
+    after DIRECTORY_TTL and the account kid and contacts after ACCOUNT_TTL;
+    valid authorizations are kept until AUTHZ_MARGIN before they expire.
+    Only what this run changed is written back, into the file as other
+    runs left it, so concurrent runs keep each other's authorizations.
+    """
+
+    DIRECTORY_TTL = 24 * 3600
+    ACCOUNT_TTL = 7 * 24 * 3600
+    AUTHZ_MARGIN = 24 * 3600
+    # Authorizations are written back at most this often, or on flush()
+    SAVE_INTERVAL = 30
+
+    def __init__(self, path, directory_url, thumbprint):
+        self.path = path
+        self.key = f"{directory_url} {thumbprint}"
+        self.lock = threading.Lock()
+        self.entry = _read_json(path).get(self.key, {})
+        # Changes not written yet: fields set (None when forgotten), and
+        # authorizations added ({url: expires}) or dropped (None)
+        self.fields = {}
+        self.authzs = {}
+        self.dirty = False
+        self.saved = time.monotonic()
+
+    def _save(self):
+        """Merge this run's changes into the file; the caller holds the lock."""
+        with _update_json(self.path) as entries:
+            entry = entries.setdefault(self.key, {})
+            for field, cached in self.fields.items():
+                if cached is None:
+                    entry.pop(field, None)
+                else:
+                    entry[field] = cached
+            authzs = entry.setdefault("authorizations", {})
+            for url, expires in self.authzs.items():
+                if expires is None:
+                    authzs.pop(url, None)
+                else:
+                    authzs[url] = expires
+            now = time.time()
+            for stale in [stale for stale, until in authzs.items() if until < now]:
+                del authzs[stale]
+        self.entry = entry
+        self.fields = {}
+        self.authzs = {}
+        self.dirty = False
+        self.saved = time.monotonic()
+
+    def get(self, field, ttl):
+        """Cached value of field, or None if missing or older than ttl seconds."""
+        with self.lock:
+            cached = self.entry.get(field)
+        if cached is None or time.time() - cached["at"] > ttl:
+            return None
+        return cached["value"]
+
+    def set(self, **fields):
+        with self.lock:
+            for field, value in fields.items():
+                self.entry[field] = self.fields[field] = {"value": value, "at": time.time()}
+            self._save()
+
+    def invalidate(self):
+        """Forget the directory and account; used when the server rejects them."""
+        with self.lock:
+            for field in ("directory", "kid", "contact"):
+                self.entry.pop(field, None)
+                self.fields[field] = None
+            self._save()
+
+    def authz_valid(self, url):
+        with self.lock:
+            expires = self.entry.get("authorizations", {}).get(url)
+        return expires is not None and expires - self.AUTHZ_MARGIN > time.time()
+
+    def add_authz(self, url, expires):
+        """Remember that the authorization at url is valid until expires."""
+        with self.lock:
+            authzs = self.entry.setdefault("authorizations", {})
+            authzs[url] = self.authzs[url] = _rfc3339_epoch(expires)
+            self.dirty = True
+            if time.monotonic() - self.saved > self.SAVE_INTERVAL:
+                self._save()
+
+    def drop_authzs(self, urls):
+        with self.lock:
+            for url in urls:
+                self.entry.get("authorizations", {}).pop(url, None)
+                self.authzs[url] = None
+            self._save()
+
+    def flush(self):
+        with self.lock:
+            if self.dirty:
+                self._save()
+
+
+class BudgetTracker:
+    """Rate-limit budget of each CA, kept in a JSON file between runs.
+
+    limits maps a directory URL to {kind: (count, window_seconds)} for the
+    kinds 'orders' (per account), 'certificates' (per registered domain)
+    and 'failures' (failed validations per hostname); a kind left out, or a
+    CA with no limits at all, is only held back while blocked after a 429.
+    Renewals, orders for the same names as a certificate already issued,
+    count as orders but not against 'certificates', as Let's Encrypt
+    exempts them from that limit. Events are timestamped, and the file is
+    merged under a lock with what other runs wrote before being replaced,
+    so overlapping cron runs share one budget.
+    """
+
+    # Events older than the longest window are dropped
+    KEEP = 7 * 24 * 3600
+    # New events are written back at most this often, or on flush()
+    SAVE_INTERVAL = 30
+
+    def __init__(self, path, limits):
+        self.path = path
+        self.limits = limits
+        self.lock = threading.Lock()
+        # Certificates ordered in this run and not yet issued or given up
+        self.pending = {}
+        self.new = {}
+        self.state = _read_json(path)
+        self.saved = time.monotonic()
+
+    @staticmethod
+    def _registered_domain(name):
+        # The last two labels; without a public suffix list this lumps
+        # together e.g. everything under co.uk, which only errs on the safe side
+        return ".".join(name.lstrip("*.").split(".")[-2:])
+
+    @staticmethod
+    def _merge(into, events):
+        for directory, entry in events.items():
+            target = into.setdefault(directory, {})
+            target["orders"] = target.get("orders", []) + entry.get("orders", [])
+            for kind in ("certificates", "failures"):
+                for name, stamps in entry.get(kind, {}).items():
+                    target.setdefault(kind, {})[name] = target.get(kind, {}).get(name, []) + stamps
+            target["blocked_until"] = max(target.get("blocked_until", 0),
+                                          entry.get("blocked_until", 0))
+
+    def _save(self):
+        """Merge new events into the file; the caller holds the lock."""
+        with _update_json(self.path) as state:
+            self._merge(state, self.new)
+            oldest = time.time() - self.KEEP
+            for entry in state.values():
+                entry["orders"] = [stamp for stamp in entry.get("orders", []) if stamp > oldest]
+                for kind in ("certificates", "failures"):
+                    names = entry.get(kind, {})
+                    for name in list(names):
+                        names[name] = [stamp for stamp in names[name] if stamp > oldest]
+                        if not names[name]:
+                            del names[name]
+        self.state = state
+        self.new = {}
+        self.saved = time.monotonic()
+
+    def _record(self, directory, kind, name=None):
+        now = time.time()
+        events = {directory: {kind: {name: [now]}} if name else {kind: [now]}}
+        self._merge(self.state, events)
+        self._merge(self.new, events)
+        if time.monotonic() - self.saved > self.SAVE_INTERVAL:
+            self._save()
+
+    def _remaining(self, directory, names, renewal=False):
+        entry = self.state.get(directory, {})
+        now = time.time()
+        if entry.get("blocked_until", 0) > now:
+            return 0
+        limits = self.limits.get(directory, {})
+
+        def used(stamps, window):
+            return sum(stamp > now - window for stamp in stamps)
+
+        left = [float("inf")]
+        if "orders" in limits:
+            count, window = limits["orders"]
+            left.append(count - used(entry.get("orders", []), window))
+        if "certificates" in limits and not renewal:
+            count, window = limits["certificates"]
+            for domain in {self._registered_domain(name) for name in names}:
+                left.append(count - used(entry.get("certificates", {}).get(domain, []), window)
+                            - self.pending.get((directory, domain), 0))
+        if "failures" in limits:
+            count, window = limits["failures"]
+            for name in names:
+                if used(entry.get("failures", {}).get(name, []), window) >= count:
+                    return 0
+        return max(min(left), 0)
+
+    def remaining(self, directory, names, renewal=False):
+        """How many more orders for names the CA at directory can take now."""
+        with self.lock:
+            return self._remaining(directory, names, renewal)
+
+    def reserve(self, directory, names, renewal=False, wait=0):
+        """Count an order for names if the budget allows it, returning whether it did.
+
+        A block after a rate limit that ends within wait seconds is waited
+        out first.
+        """
+        with self.lock:
+            blocked = self.state.get(directory, {}).get("blocked_until", 0) - time.time()
+        if 0 < blocked <= wait:
+            METRICS.sleep(blocked)
+        with self.lock:
+            if self._remaining(directory, names, renewal) < 1:
+                return False
+            self._record(directory, "orders")
+            self._hold(directory, names, renewal)
+            return True
+
+    def _hold(self, directory, names, renewal=False):
+        if renewal:
+            return
+        for domain in {self._registered_domain(name) for name in names}:
+            self.pending[directory, domain] = self.pending.get((directory, domain), 0) + 1
+
+    def hold(self, directory, names, renewal=False):
+        """Count a certificate for names as coming, for an order reserved by an earlier run."""
+        with self.lock:
+            self._hold(directory, names, renewal)
+
+    def settle(self, directory, names, issued, renewal=False):
+        """End a reserved order, counting its certificate if it was issued."""
+        if renewal:
+            return
+        with self.lock:
+            for domain in {self._registered_domain(name) for name in names}:
+                self.pending[directory, domain] -= 1
+                if issued:
+                    self._record(directory, "certificates", domain)
+
+    def failed(self, directory, name):
+        """Count a failed validation of name."""
+        with self.lock:
+            self._record(directory, "failures", name)
+
+    def block(self, directory, seconds):
+        """Take the CA out of use for seconds, after it answered with a rate limit."""
+        with self.lock:
+            events = {directory: {"blocked_until": time.time() + seconds}}
+            self._merge(self.state, events)
+            self._merge(self.new, events)
+            self._save()
+
+    def flush(self):
+        with self.lock:
+            if self.new:
+                self._save()
+
+
+class OrderJournal:
+    """Append-only journal of each order's progress, so a killed run can resume.
+
+    Every state transition appends one JSON line keyed by the absolute CSR
+    path: the CA directory, order location and authorizations when the
+    order is created, the TXT record handles while any exist, the state
+    after finalizing and the certificate URL. Lines are fsynced before the
+    run goes on. A later run merges the lines of each CSR to find where it
+    stopped; finished orders are dropped when the journal is opened.
+
+    Runs sharing the journal, such as workers sharing a --lease-dir, take
+    in each other's lines as they go, so a worker that takes over a lease
+    finds the order of the worker that held it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with _file_lock(path):
+            self.entries, _ = self._read({})
+            _atomic_write(path, "".join(json.dumps(dict(entry, key=key)) + "\n"
+                                        for key, entry in self.entries.items()))
+            # Where in which file this run has read up to
+            self.inode, self.offset = os.stat(path).st_ino, os.path.getsize(path)
+
+    def _read(self, entries, offset=0):
+        """Merge the lines of each key from offset on into entries, leaving out finished ones.
+
+        Returns entries and the offset read up to.
+        """
+        try:
+            with open(self.path, "rb") as journal_file:
+                journal_file.seek(offset)
+                for line in journal_file:
+                    if not line.endswith(b"\n"):  # the tail of a line cut short by a crash
+                        break
+                    offset += len(line)
+                    try:
+                        fields = json.loads(line)
+                    except ValueError:
+                        continue
+                    key = fields.pop("key")
+                    if fields.pop("done", False):
+                        entries.pop(key, None)
+                    else:
+                        entries.setdefault(key, {}).update(fields)
+        except FileNotFoundError:
+            pass
+        return entries, offset
+
+    def _refresh(self):
+        """Take in the lines other runs wrote since; the caller holds both locks."""
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            return
+        if inode != self.inode:
+            # Compacted by a run that started since, so read it all again
+            self.inode, self.offset = inode, 0
+            self.entries = {}
+        self.entries, self.offset = self._read(self.entries, self.offset)
+
+    @staticmethod
+    def _csr_digest(csr_file):
+        try:
+            with open(csr_file, "rb") as csr:
+                return hashlib.sha256(csr.read()).hexdigest()
+        except OSError:
+            return None
+
+    def write(self, csr_file, **fields):
+        """Durably append fields to the entry of csr_file."""
+        key = os.path.abspath(csr_file)
+        if "location" in fields:
+            fields["csr"] = self._csr_digest(csr_file)
+        line = json.dumps(dict(fields, key=key)) + "\n"
+        with self.lock, _file_lock(self.path):
+            self._refresh()
+            with open(self.path, "a") as journal_file:
+                if journal_file.tell() > self.offset:
+                    # Past the cut-short line, which is then skipped as not JSON
+                    line = "\n" + line
+                journal_file.write(line)
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            self.entries, self.offset = self._read(self.entries, self.offset)
+
+    def entry(self, csr_file):
+        """What is known of the unfinished order of csr_file, or None."""
+        with self.lock, _file_lock(self.path):
+            self._refresh()
+            entry = self.entries.get(os.path.abspath(csr_file))
+            return dict(entry) if entry else None
+
+    def resumable(self, csr_file):
+        """Whether csr_file has an order to resume, made for the CSR as it is now."""
+        entry = self.entry(csr_file)
+        return bool(entry and "location" in entry
+                    and entry.get("csr") == self._csr_digest(csr_file))
+
+    def done(self, csr_file):
+        """Mark the order of csr_file finished, or not worth resuming."""
+        if os.path.abspath(csr_file) in self.entries:
+            self.write(csr_file, done=True)
+
+
+class AcmeSession:
+    """ACME directory and account state shared by every order in a run.
+
+    The directory, account kid, JWK thumbprint and nonce chain are set up
+    once and then reused by each call to get_crt(), which is safe to call
+    from several threads at once. HTTP connections to the ACME server and
+    the DigitalOcean API are kept alive in pools sized for jobs threads.
+
+    With a CacheFile configured, the directory, account kid and valid
+    authorizations come from an AccountCache when fresh, so a warm run goes
+    straight to newOrder; if the server rejects cached data it is refreshed.
+
+    With an OrderJournal, each order's progress is written to it and an
+    order that a killed run left behind is resumed rather than made again.
+
+    With a BudgetTracker, each order is counted against the CA's budget
+    before it is created and refused with RateLimited once that runs out.
+
+    With a LeaseManager, an order is abandoned with LeaseLost before any
+    step once this worker no longer holds its lease, leaving it journaled
+    for the worker that took the lease over.
+
+    A 429 or rateLimited answer with a short Retry-After is waited out and
+    the request sent again. A longer one ends the request: at newOrder it
+    blocks the CA for its Retry-After and raises RateLimited, so the order
+    can go to another CA; for an order already under way it raises
+    AcmeExit(6), leaving the order journaled at its CA for a later run.
+    """
+
+    # Retries of a request the server rejected with badNonce, on top of
+    # (and not counted against) the backoff retries
+    BAD_NONCE_RETRIES = 5
+    # Problem types the caller handles itself, returned without retrying
+    RETURNED_ERRORS = ("orderNotReady", "userActionRequired")
+    # Problem types that mean a cached account or directory is out of date
+    STALE_ERRORS = ("accountDoesNotExist", "unauthorized")
+    # Seconds a CA is left alone after a rate limit that came without Retry-After
+    RATE_LIMIT_BLOCK = 3600
+    # Longest wait, in all, for a request that keeps being rate limited
+    RATE_LIMIT_WAIT = 60
+
+    def __init__(self, config, log=LOGGER, jobs=1, budget=None, journal=None, leases=None):
+        self.config = config
+        self.log = log
+        self.directory = config["acmednstiny"]["ACMEDirectory"]
+        self.name = config["acmednstiny"].get("CAName", self.directory)
+        self.budget = budget
+        self.journal = journal
+        self.leases = leases
+        # Longest rate limit waited out at newOrder or in the budget; a
+        # CAPool sets it to 0, as it has other CAs to go to instead
+        self.block_wait = self.RATE_LIMIT_WAIT
+        # The names of packed certificates, by cert_name; see pack_names()
+        self.packs = {}
+        self.adtheaders = {'User-Agent': 'acme-dns-tiny/2.4',
+                           'Accept-Language': config["acmednstiny"].get("Language", "en")}
+        self.http = _http_session(max(jobs, 10), self.adtheaders)
+        self.dns = dns_provider(config["acmednstiny"].get("DNSProvider", "digitalocean"),
+                                max(jobs, 10))
+        self.two_phase = config["acmednstiny"].getboolean("TwoPhase", False)
+        self.checker = PropagationChecker(
+            [server for server in config["acmednstiny"].get("DNSServers", "").split(",") if server],
+            float(config["acmednstiny"].get("DNSTimeout", 310)))
+        self.key_type = config["acmednstiny"].get("KeyType", "rsa")
+        key_spool = config["acmednstiny"].get("KeySpool", "")
+        self.key_pool = (KeyPool(key_spool, self.key_type,
+                                 int(config["acmednstiny"].get("KeyPoolSize", 50)), log=log)
+                         if key_spool else None)
+        self.poller = PollScheduler(float(config["acmednstiny"].get("PollRate", 20)))
+        self.nonces = None
+        self.from_cache = False
+        self.account_lock = threading.Lock()
+        self._load_account_key()
+        cache_file = config["acmednstiny"].get("CacheFile", "")
+        self.cache = (AccountCache(cache_file, config["acmednstiny"]["ACMEDirectory"],
+                                   self.jwk_thumbprint) if cache_file else None)
+        self._register_account()
+        self.nonces.fill(min(jobs, self.nonces.maxsize))
+        if self.key_pool:
+            self.key_pool.refill()
+
+    def _load_account_key(self):
+        self.log.info("Get private signature from account key.")
+        self.signer = self.config["acmednstiny"].get("Signer", "auto")
+        self.account_key = load_account_key(self.config["acmednstiny"]["AccountKeyFile"],
+                                            self.signer)
+        # That signature is used to authenticate with the ACME server, it needs to be safely kept
+        self.private_acme_signature = {
+            "alg": self.account_key.alg,
+            "jwk": self.account_key.jwk,
+        }
+        private_jwk = json.dumps(self.private_acme_signature["jwk"], sort_keys=True,
+                                 separators=(",", ":"))
+        self.jwk_thumbprint = _base64(hashlib.sha256(private_jwk.encode("utf8")).digest())
+
+    def _register_account(self):
+        log = self.log
+        cache = self.cache
+        self.acme_config = cache and cache.get("directory", cache.DIRECTORY_TTL)
+        if self.acme_config:
+            log.info("Use cached ACME server configuration.")
+            self.from_cache = True
         else:
-            base_domain=split_domain[2]
-        log.info('Deleting TXT record')
-        api_url = f'{do_base}domains/{base_domain}/records/{txt_id}'
+            log.info("Fetch ACME server configuration from the its directory URL.")
+            with METRICS.span("acme", "directory"):
+                self.acme_config = self.http.get(
+                    self.config["acmednstiny"]["ACMEDirectory"]).json()
+            if cache:
+                cache.set(directory=self.acme_config)
+        if self.nonces is None or self.nonces.url != self.acme_config["newNonce"]:
+            self.nonces = NoncePool(self.http, self.acme_config["newNonce"])
+        terms_service = self.acme_config.get("meta", {}).get("termsOfService", "")
 
-        requests.delete(api_url, headers=do_headers)
+        log.info("Register ACME Account to get the account identifier.")
+        account_request = {}
+        if terms_service:
+            account_request["termsOfServiceAgreed"] = True
+            log.info(("Terms of service exist and will be automatically agreed if possible, "
+                         "you should read them: %s"), terms_service)
+        account_request["contact"] = self.config["acmednstiny"].get("Contacts", "").split(';')
+        if account_request["contact"] == [""]:
+            del account_request["contact"]
 
-    def _send_signed_request(url, payload, extra_headers=None):
-        """Sends signed requests to ACME server."""
-        nonlocal nonce
-        if payload == "":  # on POST-as-GET, final payload has to be just empty string
-            payload64 = ""
+        kid = cache and cache.get("kid", cache.ACCOUNT_TTL)
+        if kid and cache.get("contact", cache.ACCOUNT_TTL) == sorted(account_request.get("contact", [])):
+            self.private_acme_signature["kid"] = kid
+            self.from_cache = True
+            log.info("  - Use cached account: '%s'", kid)
+            return
+
+        http_response, account_info = self._send_signed_request(self.acme_config["newAccount"],
+                                                                account_request)
+        if http_response.status_code == 201:
+            self.private_acme_signature["kid"] = http_response.headers['Location']
+            log.info("  - Registered a new account: '%s'", self.private_acme_signature["kid"])
+        elif http_response.status_code == 200:
+            self.private_acme_signature["kid"] = http_response.headers['Location']
+            log.debug("  - Account is already registered: '%s'", self.private_acme_signature["kid"])
+
+            http_response, account_info = self._send_signed_request(
+                self.private_acme_signature["kid"], "")
         else:
-            payload64 = _base64(json.dumps(payload).encode("utf8"))
-        protected = copy.deepcopy(private_acme_signature)
-        protected["nonce"] = nonce or requests.get(acme_config["newNonce"]).headers['Replay-Nonce']
-        del nonce
+            raise ValueError("Error registering account: {0} {1}"
+                             .format(http_response.status_code, account_info))
+
+        log.info("Update contact information if needed.")
+        if ("contact" in account_request
+                and set(account_request["contact"]) != set(account_info["contact"])):
+            http_response, result = self._send_signed_request(self.private_acme_signature["kid"],
+                                                              account_request)
+            if http_response.status_code == 200:
+                log.debug("  - Account updated with latest contact informations.")
+            else:
+                raise ValueError("Error registering updates for the account: {0} {1}"
+                                 .format(http_response.status_code, result))
+        if cache:
+            cache.set(kid=self.private_acme_signature["kid"],
+                      contact=sorted(account_request.get("contact", [])))
+
+    def _refresh_account(self, url):
+        """Drop cached directory and account state after the server rejected it.
+
+        Returns url as found in the refreshed directory, for requests that
+        were made to one of its endpoints.
+        """
+        with self.account_lock:
+            endpoints = {value: name for name, value in self.acme_config.items()
+                         if isinstance(value, str)}
+            if self.from_cache:
+                self.log.info("ACME server rejected cached account data, refreshing it.")
+                self.from_cache = False
+                self.cache.invalidate()
+                self._register_account()
+            return self.acme_config.get(endpoints.get(url), url)
+
+    def _sign(self, url, payload64):
+        """Build the JWS for a request to url, using a nonce from the pool."""
+        protected = copy.deepcopy(self.private_acme_signature)
+        protected["nonce"] = self.nonces.get()
         protected["url"] = url
-        if url == acme_config["newAccount"]:
+        if url == self.acme_config["newAccount"]:
             if "kid" in protected:
                 del protected["kid"]
         else:
             del protected["jwk"]
         protected64 = _base64(json.dumps(protected).encode("utf8"))
-        signature = _openssl("dgst", ["-sha256", "-sign", config["acmednstiny"]["AccountKeyFile"]],
-                             "{0}.{1}".format(protected64, payload64).encode("utf8"))
-        jose = {
+        signature = self.account_key.sign("{0}.{1}".format(protected64, payload64).encode("utf8"))
+        return {
             "protected": protected64, "payload": payload64, "signature": _base64(signature)
         }
+
+    def _send_signed_request(self, url, payload, extra_headers=None, log=None):
+        """Sends signed requests to ACME server."""
+        log = log or self.log
+        if payload == "":  # on POST-as-GET, final payload has to be just empty string
+            payload64 = ""
+        else:
+            payload64 = _base64(json.dumps(payload).encode("utf8"))
         joseheaders = {'Content-Type': 'application/jose+json'}
-        joseheaders.update(adtheaders)
         joseheaders.update(extra_headers or {})
+        with METRICS.span("acme", self._endpoint(url)):
+            return self._post_signed(url, payload64, joseheaders, log)
+
+    def _endpoint(self, url):
+        """Which kind of ACME resource url is, for metrics."""
+        for name, value in (self.acme_config or {}).items():
+            if value == url:
+                return name
+        for marker, kind in (("/authz", "authz"), ("/chall", "challenge"), ("/finalize", "finalize"),
+                             ("/cert", "certificate"), ("/order", "order"), ("/acct", "account"),
+                             ("/account", "account")):
+            if marker in url:
+                return kind
+        return "other"
+
+    def _post_signed(self, url, payload64, joseheaders, log):
         backoff = 1
+        bad_nonces = 0
+        refreshed = False
+        rate_limited = 0
         while True:
-            backoff = backoff * 2
             try:
-                response = requests.post(url, json=jose, headers=joseheaders)
+                response = self.http.post(url, json=self._sign(url, payload64),
+                                          headers=joseheaders)
             except requests.exceptions.RequestException as error:
                 response = error.response
-            if response:
-                nonce = response.headers['Replay-Nonce']
+            if response is not None and 'Replay-Nonce' in response.headers:
+                self.nonces.put(response.headers['Replay-Nonce'])
+            if response or (response is not None
+                            and _error_type(response) in self.RETURNED_ERRORS):
                 try:
                     return response, response.json()
                 except ValueError:  # if body is empty or not JSON formatted
                     return response, json.loads("{}")
+            elif (response is not None and self.from_cache and not refreshed
+                  and (_error_type(response) in self.STALE_ERRORS
+                       or (response.status_code == 404 and url in self.acme_config.values()))):
+                refreshed = True
+                METRICS.retry()
+                url = self._refresh_account(url)
+            elif (response is not None and _error_type(response) == "badNonce"
+                  and bad_nonces < self.BAD_NONCE_RETRIES):
+                # The error carried a fresh nonce, so re-sign and retry at once
+                bad_nonces += 1
+                METRICS.retry()
+                self.nonces.reject()
+                log.debug(f"Bad nonce from ACME server at {url}, retrying")
+            elif response is not None and (response.status_code == 429
+                                           or _error_type(response) == "rateLimited"):
+                retry_after = _retry_after(response)
+                new_order = url == self.acme_config.get("newOrder")
+                if retry_after is None and not new_order:
+                    retry_after, backoff = backoff, backoff * 2
+                if (retry_after is None or rate_limited + retry_after
+                        > (self.block_wait if new_order else self.RATE_LIMIT_WAIT)):
+                    message = f"Hit the rate limit at {self.name}: {response.text}"
+                    if not new_order:
+                        raise AcmeExit(6, message)
+                    if self.budget:
+                        self.budget.block(self.directory, retry_after or self.RATE_LIMIT_BLOCK)
+                    raise RateLimited(message, retry_after)
+                rate_limited += retry_after
+                log.info(f"Rate limited at {url}, retrying in {retry_after:.0f}s")
+                METRICS.sleep(retry_after)
             else:
+                backoff = backoff * 2
                 if backoff > 64:
                     raise RuntimeError("Unable to get response from ACME "
                         "server after multiple retries.")
-                elif response.status_code == 429:
-                    raise RuntimeError("Hit the rate limit "
-                        f"{response.text}")
                 else:
                     log.info(f"Can't reach ACME server at {url}, retrying in {backoff}s")
-                    log.info(f"{response.text}")
-                    time.sleep(backoff)
+                    if response is not None:
+                        log.info(f"{response.text}")
+                    METRICS.sleep(backoff)
 
-    # main code
-    adtheaders = {'User-Agent': 'acme-dns-tiny/2.4',
-                  'Accept-Language': config["acmednstiny"].get("Language", "en")}
-    nonce = None
+    def stats(self):
+        """Connection reuse, nonce and key pool counters for the run so far."""
+        stats = {"acme": _connection_stats(self.http),
+                 "new_nonces": self.nonces.fetched, "bad_nonce_retries": self.nonces.rejected,
+                 "polls": self.poller.polls}
+        if getattr(self.dns, "http", None):
+            stats[self.dns.name] = _connection_stats(self.dns.http)
+        if self.key_pool:
+            stats["key_pool"] = {"taken": self.key_pool.taken, "missed": self.key_pool.missed,
+                                 "generated": self.key_pool.generated}
+        return stats
 
-    log.info("Find domains to validate from the Certificate Signing Request (CSR) file.")
-    csr = _openssl("req", ["-in", config["acmednstiny"]["CSRFile"],
-                           "-noout", "-text"]).decode("utf8")
-    domains = set()
-    common_name = re.search(r"Subject:.*?\s+?CN\s*?=\s*?([^\s,;/]+)", csr)
-    if common_name is not None:
-        domains.add(common_name.group(1))
-    subject_alt_names = re.search(
-        r"X509v3 Subject Alternative Name: (?:critical)?\s+([^\r\n]+)\r?\n",
-        csr, re.MULTILINE)
-    if subject_alt_names is not None:
-        for san in subject_alt_names.group(1).split(", "):
-            if san.startswith("DNS:"):
-                domains.add(san[4:])
-    if len(domains) == 0:  # pylint: disable=len-as-condition
-        raise ValueError("Didn't find any domain to validate in the provided CSR.")
+    def log_stats(self):
+        stats = self.stats()
+        for endpoint in ("acme", self.dns.name):
+            if endpoint not in stats:
+                continue
+            self.log.info("%s: %d requests over %d connections (%d reused)", endpoint,
+                          stats[endpoint]["requests"], stats[endpoint]["connections"],
+                          stats[endpoint]["requests"] - stats[endpoint]["connections"])
+        self.log.info("newNonce requests: %d, badNonce retries: %d, status polls: %d",
+                      stats["new_nonces"], stats["bad_nonce_retries"], stats["polls"])
+        if "key_pool" in stats:
+            self.log.info("Key pool: %(taken)d keys taken, %(missed)d generated on the spot, "
+                          "%(generated)d generated ahead", stats["key_pool"])
 
-    log.info("Get private signature from account key.")
-    accountkey = _openssl("rsa", ["-in", config["acmednstiny"]["AccountKeyFile"],
-                                  "-noout", "-text"])
-    signature_search = re.search(r"modulus:\s+?00:([a-f0-9\:\s]+?)\r?\npublicExponent: ([0-9]+)",
-                                 accountkey.decode("utf8"), re.MULTILINE)
-    if signature_search is None:
-        raise ValueError("Unable to retrieve private signature.")
-    pub_hex, pub_exp = signature_search.groups()
-    pub_exp = "{0:x}".format(int(pub_exp))
-    pub_exp = "0{0}".format(pub_exp) if len(pub_exp) % 2 else pub_exp
-    # That signature is used to authenticate with the ACME server, it needs to be safely kept
-    private_acme_signature = {
-        "alg": "RS256",
-        "jwk": {
-            "e": _base64(binascii.unhexlify(pub_exp.encode("utf-8"))),
-            "kty": "RSA",
-            "n": _base64(binascii.unhexlify(re.sub(r"(\s|:)", "", pub_hex).encode("utf-8"))),
-        },
-    }
-    private_jwk = json.dumps(private_acme_signature["jwk"], sort_keys=True, separators=(",", ":"))
-    jwk_thumbprint = _base64(hashlib.sha256(private_jwk.encode("utf8")).digest())
-
-    log.info("Fetch ACME server configuration from the its directory URL.")
-    acme_config = requests.get(config["acmednstiny"]["ACMEDirectory"], headers=adtheaders).json()
-    terms_service = acme_config.get("meta", {}).get("termsOfService", "")
-
-    log.info("Register ACME Account to get the account identifier.")
-    account_request = {}
-    if terms_service:
-        account_request["termsOfServiceAgreed"] = True
-        log.info(("Terms of service exist and will be automatically agreed if possible, "
-                     "you should read them: %s"), terms_service)
-    account_request["contact"] = config["acmednstiny"].get("Contacts", "").split(';')
-    if account_request["contact"] == [""]:
-        del account_request["contact"]
-
-    http_response, account_info = _send_signed_request(acme_config["newAccount"], account_request)
-    if http_response.status_code == 201:
-        private_acme_signature["kid"] = http_response.headers['Location']
-        log.info("  - Registered a new account: '%s'", private_acme_signature["kid"])
-    elif http_response.status_code == 200:
-        private_acme_signature["kid"] = http_response.headers['Location']
-        log.debug("  - Account is already registered: '%s'", private_acme_signature["kid"])
-
-        http_response, account_info = _send_signed_request(private_acme_signature["kid"], "")
-    else:
-        raise ValueError("Error registering account: {0} {1}"
-                         .format(http_response.status_code, account_info))
-
-    log.info("Update contact information if needed.")
-    if ("contact" in account_request
-            and set(account_request["contact"]) != set(account_info["contact"])):
-        http_response, result = _send_signed_request(private_acme_signature["kid"],
-                                                     account_request)
-        if http_response.status_code == 200:
-            log.debug("  - Account updated with latest contact informations.")
+    def close(self):
+        """Write back the cache and budget, stop polling and refilling the key pool."""
+        if self.cache:
+            self.cache.flush()
+        if self.budget:
+            self.budget.flush()
+        self.poller.close()
+        if self.key_pool:
+            self.key_pool.close()
+
+    def test_txt(self, domain, keydigest64, log=LOGGER):
+        log.info(f'Testing TXT record for {domain}')
+        with METRICS.span("propagation"):
+            self.checker.wait({domain: {keydigest64}}, log)
+
+    def get_crt(self, csr_file, log=None):
+        """Get ACME certificate by resolving DNS challenge."""
+        return AcmeOrder(self, csr_file, log).run()
+
+
+class AcmeOrder:
+    """One certificate order, advanced a step at a time through its states.
+
+    state follows the ACME order status ('pending', 'ready', 'processing',
+    'valid') starting from 'new', and becomes 'done' once the certificate
+    chain has been downloaded into self.certificate.
+    """
+
+    # Seconds to wait for a challenge to be validated and a finalized order to be issued
+    VALIDATION_TIMEOUT = 300
+    PROCESSING_TIMEOUT = 600
+
+    def __init__(self, session, csr_file, log=None):
+        self.session = session
+        self.csr_file = csr_file
+        self.log = log or session.log
+        self.state = 'new'
+        self.location = None
+        self.order = None
+        self.certificate = None
+        self.csr = None
+        # Retry-After of the last response that asked to wait
+        self.retry_after = None
+        # Authorizations skipped because the cache had them as valid
+        self.cached_authzs = []
+        # Whether create() counted this order against the session's budget,
+        # and whether it did so as a renewal
+        self.reserved = False
+        self.renewal = False
+
+    def _send_signed_request(self, url, payload, extra_headers=None):
+        return self.session._send_signed_request(url, payload, extra_headers, self.log)
+
+    def read_csr(self):
+        """Return the CSR's domains and DER encoding, reading the file only once."""
+        if self.csr is None:
+            self.log.info("Find domains to validate from the Certificate Signing Request (CSR) file.")
+            self.csr = read_csr(self.csr_file, self.session.signer)
+        return self.csr
+
+    def create(self):
+        """Request a new order for the CSR's domains."""
+        log = self.log
+        log.info("Request to the ACME server an order to validate domains.")
+        domains = self.read_csr()[0]
+        budget = self.session.budget
+        if budget:
+            self.renewal = _renews(self.csr_file)
+            if not budget.reserve(self.session.directory, domains, self.renewal,
+                                  self.session.block_wait):
+                raise RateLimited("Out of rate-limit budget at {0} for {1}".format(
+                    self.session.name, ", ".join(domains)))
+            self.reserved = True
+        new_order = {"identifiers": [{"type": "dns", "value": domain} for domain in domains]}
+        http_response, order = self._send_signed_request(self.session.acme_config["newOrder"],
+                                                         new_order)
+        if http_response.status_code == 201:
+            self.location = http_response.headers['Location']
+            log.debug("  - Order received: %s", self.location)
+            if order["status"] != "pending" and order["status"] != "ready":
+                raise ValueError("Order status is neither pending neither ready, we can't use it: {0}"
+                                 .format(order))
+            self.checkpoint(directory=self.session.directory, location=self.location,
+                            authzs=order["authorizations"], records=[])
+        elif (http_response.status_code == 403
+              and order["type"] == "urn:ietf:params:acme:error:userActionRequired"):
+            raise ValueError(("Order creation failed ({0}). Read Terms of Service ({1}), then follow "
+                              "your CA instructions: {2}")
+                             .format(order["detail"],
+                                     http_response.headers['Link'], order["instance"]))
+        else:
+            raise ValueError("Error getting new Order: {0} {1}"
+                             .format(http_response.status_code, order))
+        self.order = order
+        self.state = order["status"]
+
+    def checkpoint(self, **fields):
+        """Journal the order's progress, if the session keeps a journal."""
+        if self.session.journal and self.location:
+            self.session.journal.write(self.csr_file, **fields)
+
+    def resume(self):
+        """Pick the order up where a run that was killed left it, returning whether it could.
+
+        TXT records the run left behind are deleted first. The order is
+        then fetched again, since the CA knows best how far it got.
+        """
+        log = self.log
+        journal = self.session.journal
+        entry = journal and journal.entry(self.csr_file)
+        if not entry:
+            return False
+        if entry.get("records"):
+            log.info("Delete %d TXT record(s) left by an interrupted run", len(entry["records"]))
+            self.session.dns.delete_records([tuple(record) for record in entry["records"]], log)
+            journal.write(self.csr_file, records=[])
+        if (entry.get("directory") != self.session.directory
+                or not journal.resumable(self.csr_file)):
+            journal.done(self.csr_file)
+            return False
+        http_response, order = self._send_signed_request(entry["location"], "")
+        if (http_response.status_code != 200
+                or order.get("status") not in ("pending", "ready", "processing", "valid")):
+            log.info("Journaled order %s can't be resumed (%s), starting over",
+                     entry["location"], order.get("status", http_response.status_code))
+            journal.done(self.csr_file)
+            return False
+        log.info("Resume order %s, %s", entry["location"], order["status"])
+        if self.session.budget:
+            # Counted as an order by the run that made it
+            self.renewal = _renews(self.csr_file)
+            self.session.budget.hold(self.session.directory, self.read_csr()[0], self.renewal)
+            self.reserved = True
+        self.location = entry["location"]
+        self.order = order
+        self.state = order["status"]
+        return True
+
+    def authorize(self):
+        """Complete each authorization challenge of a pending order."""
+        if self.session.two_phase:
+            error = authorize_orders([self], self.session, self.log).get(self)
+            if error is not None:
+                raise error
         else:
-            raise ValueError("Error registering updates for the account: {0} {1}"
+            for authz in self.order["authorizations"]:
+                for challenge in self.challenges([authz]):
+                    self.authorize_one(challenge)
+        self.state = 'ready'
+
+    def challenges(self, authzs=None):
+        """Fetch authorizations, returning the dns-01 challenge of each pending one.
+
+        Each challenge is returned as a dict with the domain, its TXT record
+        name and the keydigest64 value the record has to hold.
+        """
+        log = self.log
+        cache = self.session.cache
+        challenges = []
+        for authz in self.order["authorizations"] if authzs is None else authzs:
+            if cache and cache.authz_valid(authz):
+                log.info("Skip authorization %s: cached as valid", authz)
+                self.cached_authzs.append(authz)
+                continue
+            log.info("Process challenge for authorization: %s", authz)
+            # get new challenge
+            http_response, authorization = self._send_signed_request(authz, "")
+            if http_response.status_code != 200:
+                raise ValueError("Error fetching challenges: {0} {1}"
+                                 .format(http_response.status_code, authorization))
+            domain = authorization["identifier"]["value"]
+
+            if authorization["status"] == "valid":
+                log.info("Skip authorization for domain %s: this is already validated", domain)
+                if cache and "expires" in authorization:
+                    cache.add_authz(authz, authorization["expires"])
+                continue
+            if authorization["status"] != "pending":
+                raise ValueError("Authorization for the domain {0} can't be validated: "
+                                 "the authorization is {1}.".format(domain, authorization["status"]))
+
+            dns_challenges = [c for c in authorization["challenges"] if c["type"] == "dns-01"]
+            if not dns_challenges:
+                raise ValueError("Unable to find a DNS challenge to resolve for domain {0}"
+                                 .format(domain))
+            challenge = dns_challenges[0]
+            keyauthorization = challenge["token"] + "." + self.session.jwk_thumbprint
+            keydigest64 = _base64(hashlib.sha256(keyauthorization.encode("utf8")).digest())
+            challenges.append({"domain": domain, "url": challenge["url"],
+                               "dnsrr_domain": f'_acme-challenge.{domain}',
+                               "keydigest64": keydigest64, "record": None, "retry_after": None,
+                               "authz": authz, "expires": authorization.get("expires")})
+        return challenges
+
+    def provision(self, challenge):
+        """Create the TXT record for a challenge."""
+        self.log.info("Install DNS TXT resource for domain: %s", challenge["domain"])
+        self.log.info(f"Challenge contents: {challenge['keydigest64']}")
+        [(challenge["record"], error)] = self.session.dns.create_records(
+            [(challenge["dnsrr_domain"], challenge["keydigest64"])], self.log)
+        if error is not None:
+            raise error
+        self.checkpoint(records=[challenge["record"]])
+
+    def teardown(self, challenge):
+        """Delete the TXT record of a challenge, if one was created."""
+        if challenge["record"] is not None:
+            left = self.session.dns.delete_records([challenge["record"]], self.log)
+            challenge["record"] = None
+            self.checkpoint(records=list(left))
+
+    def trigger(self, challenge):
+        """Ask the ACME server to validate a challenge, returning the status it answers with."""
+        self.log.info("Asking ACME server to validate challenge.")
+        http_response, result = self._send_signed_request(challenge["url"], {})
+        if http_response.status_code != 200:
+            raise ValueError("Error triggering challenge: {0} {1}"
                              .format(http_response.status_code, result))
+        return self._challenge_state(challenge, http_response, result)
 
-    # new order
-    log.info("Request to the ACME server an order to validate domains.")
-    new_order = {"identifiers": [{"type": "dns", "value": domain} for domain in domains]}
-    http_response, order = _send_signed_request(acme_config["newOrder"], new_order)
-    if http_response.status_code == 201:
-        order_location = http_response.headers['Location']
-        log.debug("  - Order received: %s", order_location)
-        if order["status"] != "pending" and order["status"] != "ready":
-            raise ValueError("Order status is neither pending neither ready, we can't use it: {0}"
-                             .format(order))
-    elif (http_response.status_code == 403
-          and order["type"] == "urn:ietf:params:acme:error:userActionRequired"):
-        raise ValueError(("Order creation failed ({0}). Read Terms of Service ({1}), then follow "
-                          "your CA instructions: {2}")
-                         .format(order["detail"],
-                                 http_response.headers['Link'], order["instance"]))
-    else:
-        raise ValueError("Error getting new Order: {0} {1}"
-                         .format(http_response.status_code, order))
-
-    # complete each authorization challenge
-    for authz in order["authorizations"]:
-        if order["status"] == "ready":
-            log.info("No challenge to process: order is already ready.")
-            break
-
-        log.info("Process challenge for authorization: %s", authz)
-        # get new challenge
-        http_response, authorization = _send_signed_request(authz, "")
+    def challenge_status(self, challenge):
+        """Return a triggered challenge's status, logging why it isn't valid yet."""
+        http_response, challenge_status = self._send_signed_request(challenge["url"], "")
         if http_response.status_code != 200:
-            raise ValueError("Error fetching challenges: {0} {1}"
-                             .format(http_response.status_code, authorization))
-        domain = authorization["identifier"]["value"]
-
-        if authorization["status"] == "valid":
-            log.info("Skip authorization for domain %s: this is already validated", domain)
-            continue
-        if authorization["status"] != "pending":
-            raise ValueError("Authorization for the domain {0} can't be validated: "
-                             "the authorization is {1}.".format(domain, authorization["status"]))
-
-        challenges = [c for c in authorization["challenges"] if c["type"] == "dns-01"]
-        if not challenges:
-            raise ValueError("Unable to find a DNS challenge to resolve for domain {0}"
-                             .format(domain))
-        log.info("Install DNS TXT resource for domain: %s", domain)
-        challenge = challenges[0]
-        keyauthorization = challenge["token"] + "." + jwk_thumbprint
-        keydigest64 = _base64(hashlib.sha256(keyauthorization.encode("utf8")).digest())
-        log.info(f"Challenge contents: {keydigest64}")
-        dnsrr_domain = f'_acme-challenge.{domain}'
-        txt_id=create_txt(dnsrr_domain,keydigest64)
-        test_txt(dnsrr_domain)
-
-        log.info("Asking ACME server to validate challenge.")
-        http_response, result = _send_signed_request(challenge["url"], {})
+            raise ValueError("Error during challenge validation: {0} {1}".format(
+                http_response.status_code, challenge_status))
+        return self._challenge_state(challenge, http_response, challenge_status)
+
+    def _challenge_state(self, challenge, http_response, challenge_status):
+        """Note the Retry-After of a challenge response and act on its status.
+
+        An invalid challenge is final, so it fails the validation at once.
+        """
+        log = self.log
+        challenge["retry_after"] = _retry_after(http_response)
+        if challenge_status["status"] == "valid":
+            log.info("ACME has verified challenge for domain: %s", challenge["domain"])
+            if self.session.cache and challenge["expires"]:
+                # A pending authorization's expiry is earlier than the valid one's
+                self.session.cache.add_authz(challenge["authz"], challenge["expires"])
+        elif challenge_status["status"] in ("processing", "pending"):
+            log.info(f"Certificate isn't ready yet - {challenge_status['status']}")
+        elif challenge_status["status"] == "invalid":
+            log.warning("Validation failed, maybe DNS not propogated yet")
+            log.info(http_response.text)
+            if self.session.budget:
+                self.session.budget.failed(self.session.directory, challenge["domain"])
+            raise AcmeExit(4, "Validation failed for {0}: {1}".format(
+                challenge["domain"], challenge_status.get("error", {}).get("detail", "invalid")))
+        else:
+            raise ValueError(f"Challenge for domain {challenge['domain']} did not"
+                             f"pass: {challenge_status}")
+        return challenge_status["status"]
+
+    def poll_challenge(self, challenge):
+        """Have the session's poller check a triggered challenge until it is valid.
+
+        Returns a Future, which fails with AcmeExit(4) if the challenge
+        isn't valid within VALIDATION_TIMEOUT seconds.
+        """
+        def check():
+            if self.challenge_status(challenge) == "valid":
+                return True, None
+            return None, challenge["retry_after"]
+        return self.session.poller.schedule(
+            check, challenge["retry_after"], self.VALIDATION_TIMEOUT,
+            lambda: AcmeExit(4, f"Validation failed for {challenge['domain']} "
+                             "after multiple retries"))
+
+    def authorize_one(self, challenge):
+        """Provision, propagate and validate a single challenge."""
+        log = self.log
+        self.provision(challenge)
+        try:
+            self.session.test_txt(challenge["dnsrr_domain"], challenge["keydigest64"], log)
+            with METRICS.span("validation"):
+                if self.trigger(challenge) != "valid":
+                    self.session.poller.result(self.poll_challenge(challenge))
+        finally:
+            self.teardown(challenge)
+
+    def finalize(self):
+        """Send the CSR once all challenges have been completed."""
+        self.log.info("Request to finalize the order (all challenges have been completed)")
+        csr_der = _base64(self.read_csr()[1])
+        http_response, result = self._send_signed_request(self.order["finalize"], {"csr": csr_der})
+        if _error_type(http_response) == "orderNotReady" and self.cached_authzs:
+            self.log.info("Order not ready: authorizations cached as valid are not, "
+                          "authorizing them again")
+            self.session.cache.drop_authzs(self.cached_authzs)
+            self.cached_authzs = []
+            self.state = 'pending'
+            return
         if http_response.status_code != 200:
-            raise ValueError("Error triggering challenge: {0} {1}"
+            raise ValueError("Error while sending the CSR: {0} {1}"
                              .format(http_response.status_code, result))
+        # The response is the order itself, which may already be valid
+        self.order = result
+        self.retry_after = _retry_after(http_response)
+        if result.get("status") == "valid":
+            self.log.info("Order finalized!")
+            self.state = 'valid'
+        else:
+            self.state = 'processing'
+        self.checkpoint(state=self.state, certificate=result.get("certificate"))
+
+    def poll(self):
+        """Wait for a finalized order to become valid."""
+        def check():
+            http_response, order = self._send_signed_request(self.location, "")
+            if order["status"] == "valid":
+                return order, None
+            if order["status"] == "processing":
+                return None, _retry_after(http_response)
+            raise ValueError("Finalizing order {0} got errors: {1}".format(
+                self.location, order))
+        self.order = self.session.poller.wait(check, self.retry_after, self.PROCESSING_TIMEOUT)
+        self.log.info("Order finalized!")
+        self.state = 'valid'
+        self.checkpoint(state=self.state, certificate=self.order["certificate"])
+
+    def download(self):
+        """Fetch the certificate chain of a valid order."""
+        log = self.log
+        http_response, result = self._send_signed_request(
+            self.order["certificate"], "",
+            {'Accept': self.session.config["acmednstiny"].get("CertificateFormat",
+                                                              'application/pem-certificate-chain')})
+        if http_response.status_code != 200:
+            raise ValueError("Finalizing order {0} got errors: {1}"
+                             .format(http_response.status_code, result))
+
+        if 'link' in http_response.headers:
+            log.info("  - Certificate links given by server: %s", http_response.headers['link'])
+
+        log.info("Certificate signed and chain received: %s", self.order["certificate"])
+        self.certificate = http_response.text
+        self.release(issued=True)
+        self.state = 'done'
+
+    def release(self, issued=False):
+        """Settle the budget create() reserved, counting the certificate if it was issued."""
+        if self.reserved:
+            self.reserved = False
+            self.session.budget.settle(self.session.directory, self.read_csr()[0], issued,
+                                       self.renewal)
+
+    # Metrics phase of each state's step
+    PHASES = {'new': 'order', 'pending': 'authorize', 'ready': 'finalize',
+              'processing': 'poll', 'valid': 'download'}
+
+    def step(self):
+        """Advance the order by one state, timed as that state's phase."""
+        leases = self.session.leases
+        if leases and not leases.holds(os.path.splitext(self.csr_file)[0]):
+            raise LeaseLost(f"Lost the lease of {self.csr_file}, leaving its order to "
+                            f"the worker that took it over")
+        with METRICS.span(self.PHASES.get(self.state, self.state)):
+            try:
+                self._step()
+            except Exception:
+                self.release()
+                raise
+
+    def _step(self):
+        if self.state == 'new':
+            if not self.resume():
+                self.create()
+        elif self.state == 'pending':
+            self.authorize()
+        elif self.state == 'ready':
+            if self.order["status"] == "ready":
+                self.log.info("No challenge to process: order is already ready.")
+            self.finalize()
+        elif self.state == 'processing':
+            self.poll()
+        elif self.state == 'valid':
+            self.download()
+        else:
+            raise ValueError(f"Order {self.location} is in unexpected state {self.state}")
+
+    def run(self):
+        """Step the order through to the end and return the certificate chain."""
+        while self.state != 'done':
+            self.step()
+        return self.certificate
+
+
+# pylint: disable=too-many-branches
+def authorize_orders(orders, session, log=LOGGER):
+    """Authorize many pending orders together in two phases.
+
+    Every dns-01 TXT record of every order is created first and propagation
+    is waited for once across all of them; then all challenges are
+    triggered and their statuses polled together. All records are deleted
+    in one teardown at the end, whatever happened. Returns {order: error}
+    for the orders that failed; the others can go on to be finalized.
+
+    Records are created and deleted in one batch per DNS zone. What
+    happens to each order is logged to its own log; log gets what the
+    orders share, such as the DNS provider's and the checker's messages,
+    and with more than one order a summary of each step.
+    """
+    errors = {}
+    challenges = {}
+    provisioned = []
+
+    def fail(order, error):
+        errors[order] = error
+        challenges.pop(order, None)
+
+    try:
+        for order in orders:
+            try:
+                challenges[order] = order.challenges()
+            except Exception as error:  # pylint: disable=broad-except
+                fail(order, error)
+        wanted = [(order, challenge) for order, order_challenges in challenges.items()
+                  for challenge in order_challenges]
+        for order, challenge in wanted:
+            order.log.info("Install DNS TXT resource for domain: %s", challenge["domain"])
+        created = session.dns.create_records(
+            [(challenge["dnsrr_domain"], challenge["keydigest64"]) for _, challenge in wanted], log)
+        for (order, challenge), (record, error) in zip(wanted, created):
+            if error is None:
+                challenge["record"] = record
+                provisioned.append((order, challenge))
+            elif order not in errors:
+                fail(order, error)
+        for order in dict.fromkeys(order for order, _ in provisioned):
+            order.checkpoint(records=[challenge["record"] for owner, challenge in provisioned
+                                      if owner is order])
+
+        # A wildcard and its base domain share a record name, each with its own value
+        records = {}
+        for order_challenges in challenges.values():
+            for challenge in order_challenges:
+                records.setdefault(challenge["dnsrr_domain"], set()).add(challenge["keydigest64"])
+        if records:
+            for order, order_challenges in challenges.items():
+                if order_challenges:
+                    order.log.info(f"Waiting for {len(order_challenges)} TXT record(s) "
+                                   f"to propagate")
+            if len(orders) > 1:
+                log.info(f"Waiting for {sum(map(len, records.values()))} TXT record(s) "
+                         f"of {len(challenges)} orders to propagate")
+            with METRICS.span("propagation"):
+                missing = session.checker.missing(records, log)
+            for order, order_challenges in list(challenges.items()):
+                unpropagated = [c["dnsrr_domain"] for c in order_challenges
+                                if c["dnsrr_domain"] in missing]
+                if len(orders) > 1:
+                    for challenge in order_challenges:
+                        if challenge["dnsrr_domain"] not in missing:
+                            order.log.info(f'TXT record found for {challenge["dnsrr_domain"]}')
+                if unpropagated:
+                    order.log.warning('Waited too long for DNS')
+                    fail(order, AcmeExit(3, 'Waited too long for DNS propagation of {0}'
+                                         .format(', '.join(unpropagated))))
+
+        with METRICS.span("validation"):
+            # Every challenge not valid straight away is polled by the session's poller
+            polls = []
+            for order, order_challenges in list(challenges.items()):
+                try:
+                    for challenge in order_challenges:
+                        if order.trigger(challenge) != "valid":
+                            polls.append((order, order.poll_challenge(challenge)))
+                except Exception as error:  # pylint: disable=broad-except
+                    fail(order, error)
+            for order in dict.fromkeys(order for order, _ in polls):
+                order.log.info(f"Waiting for {sum(owner is order for owner, _ in polls)} "
+                               f"challenge(s) to be validated")
+            if len(orders) > 1 and polls:
+                log.info(f"Waiting for {len(polls)} challenge(s) to be validated")
+            for order, poll in polls:
+                if order in errors:
+                    poll.cancel()
+                    continue
+                try:
+                    session.poller.result(poll)
+                except Exception as error:  # pylint: disable=broad-except
+                    order.log.warning(f"Validation failed: {error}")
+                    fail(order, error)
+    finally:
+        if provisioned:
+            for order in dict.fromkeys(order for order, _ in provisioned):
+                order.log.info('Deleting TXT record(s)')
+            left = session.dns.delete_records([challenge["record"]
+                                               for _, challenge in provisioned], log)
+            for order in dict.fromkeys(order for order, _ in provisioned):
+                order.checkpoint(records=[challenge["record"] for owner, challenge in provisioned
+                                          if owner is order and challenge["record"] in left])
+    return errors
+
+
+def get_crt(config, log=LOGGER):
+    """Get ACME certificate by resolving DNS challenge."""
+    return AcmeSession(config, log).get_crt(config["acmednstiny"]["CSRFile"], log)
+
+
+class CAPool:
+    """Several CAs standing in for one AcmeSession, spreading orders by budget.
+
+    Each certificate goes to the CA with the most rate-limit budget left
+    per order it already has in flight, so the work in flight follows the
+    remaining budgets. When a CA answers with a rate limit, or turns out to
+    be out of budget, the same CSR is ordered from the next best CA; an
+    order already under way stays where it is. Waves of --two-phase orders
+    would have to stay on one CA, so the pool issues one certificate at a
+    time, still authorizing each in two phases.
+    A journaled order goes back to the CA it was made at first.
+    """
+
+    two_phase = False
+
+    def __init__(self, configs, log=LOGGER, jobs=1, budget=None, journal=None, leases=None):
+        self.log = log
+        self.budget = budget
+        self.journal = journal
+        self.sessions = []
+        for config in configs:
+            try:
+                self.sessions.append(AcmeSession(config, log, jobs, budget, journal, leases))
+            except Exception as error:  # pylint: disable=broad-except
+                log.warning("Leaving out %s: %s", config["acmednstiny"].get("CAName"), error)
+        if not self.sessions:
+            raise AcmeExit(6, "No CA could be set up")
+        if len(self.sessions) > 1:
+            for session in self.sessions:
+                session.block_wait = 0
+        first = self.sessions[0]
+        self.http, self.acme_config = first.http, first.acme_config
+        self.key_type, self.key_pool = first.key_type, first.key_pool
+        self.dns = first.dns
+        self.in_flight = {session: 0 for session in self.sessions}
+        self.packs = {}
+        self.lock = threading.Lock()
+
+    def _pick(self, domains, tried, directory=None, renewal=False):
+        """The untried session with the most budget per order in flight, or None.
+
+        The session of directory comes first while it has any budget left.
+        """
+        with self.lock:
+            scores = {session: (self.budget.remaining(session.directory, domains, renewal)
+                                if self.budget else 1) / (1 + self.in_flight[session])
+                      for session in self.sessions if session not in tried}
+            scores = {session: score for session, score in scores.items() if score > 0}
+            if not scores:
+                return None
+            session = max(scores, key=lambda session: (session.directory == directory,
+                                                       scores[session]))
+            self.in_flight[session] += 1
+            return session
+
+    def get_crt(self, csr_file, log=None):
+        """Get the certificate from the best CA, failing over on rate limits."""
+        log = log or self.log
+        domains = read_csr(csr_file, self.sessions[0].signer)[0]
+        entry = self.journal and self.journal.entry(csr_file)
+        renewal = _renews(csr_file)
+        tried = set()
+        while True:
+            session = self._pick(domains, tried, entry and entry.get("directory"), renewal)
+            if session is None:
+                raise RateLimited("Rate limited or out of budget at every CA for {0}"
+                                  .format(", ".join(domains)))
+            log.info("Ordering from %s", session.name)
+            try:
+                return session.get_crt(csr_file, log)
+            except RateLimited as error:
+                log.warning("%s, trying the next CA", error)
+                tried.add(session)
+            finally:
+                with self.lock:
+                    self.in_flight[session] -= 1
+
+    def stats(self):
+        return {session.name: session.stats() for session in self.sessions}
+
+    def log_stats(self):
+        for session in self.sessions:
+            session.log.info("%s:", session.name)
+            session.log_stats()
+
+    def close(self):
+        for session in self.sessions:
+            session.close()
+
+
+def open_session(configs, log=LOGGER, jobs=1, budget=None, journal=None, leases=None):
+    """An AcmeSession for a single CA, or a CAPool spreading orders over several."""
+    if len(configs) == 1:
+        return AcmeSession(configs[0], log, jobs, budget, journal, leases)
+    return CAPool(configs, log, jobs, budget, journal, leases)
+
+
+class RenewalScheduler:
+    """Work out which issued certificates are due for renewal.
+
+    scan() walks a directory tree for <name>.cert.pem (or, failing that,
+    <name>.fullchain.pem) files. A certificate is only read again when its
+    mtime or size changed since the last run, as recorded in a small JSON
+    index, so repeated scans of a large tree are cheap.
+
+    A certificate is due window_days before it expires, brought forward by
+    up to jitter_hours depending on its name, so that a fleet issued in one
+    go doesn't all come due in the same hour. When the CA advertises ACME
+    Renewal Information (ARI), a time within its suggested window is used
+    if that comes sooner, so the CA can bring a renewal forward but never
+    put it off past window_days.
+    """
+
+    SUFFIXES = (".cert.pem", ".fullchain.pem")
+    # How long to trust an ARI answer that came without a Retry-After
+    ARI_RETRY = 6 * 3600
+
+    def __init__(self, root, index_file=None, window_days=30, jitter_hours=72,
+                 http=None, renewal_info=None, signer="auto", log=LOGGER):
+        self.root = root
+        self.index_file = index_file or os.path.join(root, ".acme_certs_index.json")
+        self.window = window_days * 86400
+        self.jitter = jitter_hours * 3600
+        self.http = http
+        self.renewal_info = renewal_info
+        self.signer = signer
+        self.log = log
         try:
-            backoff = 1
-            while True:
-                backoff = backoff * 2
-                http_response, challenge_status = _send_signed_request(challenge["url"], "")
-                if http_response.status_code != 200:
-                    raise ValueError("Error during challenge validation: {0} {1}".format(
-                        http_response.status_code, challenge_status))
-                if challenge_status["status"] == "valid":
-                    log.info("ACME has verified challenge for domain: %s", domain)
+            with open(self.index_file) as index:
+                self.index = json.load(index)
+        except (OSError, ValueError):
+            self.index = {}
+
+    @staticmethod
+    def _spread(cert_name):
+        """A fraction in [0, 1) fixed for each name, so every run agrees on it."""
+        return int(hashlib.sha256(cert_name.encode("utf8")).hexdigest()[:8], 16) / 0x100000000
+
+    def scan(self):
+        """Refresh the index from the tree, returning its entries by path."""
+        with METRICS.span("scan"):
+            return self._scan()
+
+    def _scan(self):
+        found = {}
+        for directory, _, files in os.walk(self.root):
+            seen = set()
+            for suffix in self.SUFFIXES:
+                for filename in files:
+                    cert_name = filename[:-len(suffix)]
+                    if not filename.endswith(suffix) or cert_name in seen:
+                        continue
+                    seen.add(cert_name)
+                    path = os.path.join(directory, filename)
+                    stat = os.stat(path)
+                    entry = self.index.get(path)
+                    if (entry is None or entry["mtime"] != stat.st_mtime
+                            or entry["size"] != stat.st_size):
+                        try:
+                            not_after, cert_id = read_cert(path, self.signer)
+                        except (IOError, ValueError) as error:
+                            self.log.warning(f"Skipping unreadable certificate {path}: {error}")
+                            continue
+                        entry = {"name": cert_name, "dir": directory, "mtime": stat.st_mtime,
+                                 "size": stat.st_size, "not_after": not_after,
+                                 "cert_id": cert_id}
+                    found[path] = entry
+        self.index = found
+        return found
+
+    def _ari_time(self, entry, now):
+        """Renewal time within the CA's suggested window, or None without ARI."""
+        if not (self.renewal_info and self.http and entry.get("cert_id")):
+            return None
+        if entry.get("ari_until", 0) < now:
+            try:
+                with METRICS.span("acme", "renewalInfo"):
+                    response = self.http.get(
+                        f'{self.renewal_info.rstrip("/")}/{entry["cert_id"]}')
+                response.raise_for_status()
+                window = response.json()["suggestedWindow"]
+                entry["ari_start"] = _rfc3339_epoch(window["start"])
+                entry["ari_end"] = _rfc3339_epoch(window["end"])
+                try:
+                    retry_after = int(response.headers["Retry-After"])
+                except (KeyError, ValueError):
+                    retry_after = self.ARI_RETRY
+                entry["ari_until"] = now + retry_after
+            except (requests.exceptions.RequestException, KeyError, ValueError) as error:
+                self.log.info(f"No renewal information for {entry['name']}: {error}")
+                return None
+        return (entry["ari_start"]
+                + (entry["ari_end"] - entry["ari_start"]) * self._spread(entry["name"]))
+
+    def renew_at(self, entry, now):
+        """When the certificate of an index entry should be renewed."""
+        renew_at = entry["not_after"] - self.window - self.jitter * self._spread(entry["name"])
+        ari_time = self._ari_time(entry, now)
+        return renew_at if ari_time is None else min(ari_time, renew_at)
+
+    def due(self, now=None):
+        """Scan, then return the entries due for renewal, soonest expiry first."""
+        now = now or time.time()
+        queue = sorted((entry for entry in self.scan().values()
+                        if self.renew_at(entry, now) <= now),
+                       key=lambda entry: entry["not_after"])
+        self.save()
+        self.log.info(f"{len(queue)} of {len(self.index)} certificates under {self.root} "
+                      "are due for renewal")
+        return queue
+
+    def save(self):
+        _atomic_write(self.index_file, json.dumps(self.index))
+
+
+class LeaseManager:
+    """Expiring leases in a shared directory, so several workers split one list of names.
+
+    A lease is a small file created with O_EXCL; its owner touches it every
+    ttl/3 seconds, and one left untouched for ttl seconds is taken over by
+    whichever worker gets to rename it aside first. A lease whose file
+    names another worker, or that couldn't be touched for 2/3 of ttl, say
+    while the shared filesystem errs, no longer holds(), and the orders
+    under it stop before their next step. A finished name keeps
+    its file, marked done, so workers started within ttl of each other skip
+    it. Leases are keyed by the name's absolute path, so certificates kept
+    in different directories don't collide.
+    """
+
+    def __init__(self, directory, worker=None, ttl=300, log=LOGGER):
+        self.directory = directory
+        self.worker = worker or f"{os.uname().nodename}.{os.getpid()}"
+        self.ttl = ttl
+        # How often names other workers hold are looked at again
+        self.recheck = min(ttl / 6, 2)
+        self.log = log
+        self.started = time.time()
+        # When each lease held was last touched
+        self.held = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.heartbeat = None
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, cert_name, directory="."):
+        key = hashlib.sha256(os.path.abspath(os.path.join(directory, cert_name))
+                             .encode("utf8")).hexdigest()[:32]
+        return os.path.join(self.directory, f"{key}.lease")
+
+    @staticmethod
+    def _read(path):
+        try:
+            with open(path) as lease_file:
+                return json.load(lease_file)
+        except ValueError:  # created but not written yet
+            return {}
+
+    def _write(self, path, cert_name, **fields):
+        with open(path, "w") as lease_file:
+            json.dump(dict(fields, worker=self.worker, name=cert_name), lease_file)
+
+    def claim(self, cert_name, directory="."):
+        """Try to take cert_name: returns 'claimed', 'held' by a live worker, or 'done'."""
+        path = self._path(cert_name, directory)
+        for _ in range(2):
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+            except FileExistsError:
+                pass
+            else:
+                self._write(path, cert_name)
+                with self.lock:
+                    self.held[path] = time.time()
+                if self.heartbeat is None:
+                    self.heartbeat = threading.Thread(target=self._beat, daemon=True)
+                    self.heartbeat.start()
+                return "claimed"
+            try:
+                touched, lease = os.stat(path).st_mtime, self._read(path)
+            except FileNotFoundError:
+                continue
+            if lease.get("done") and touched > self.started - self.ttl:
+                return "done"
+            if not lease.get("done") and touched > time.time() - self.ttl:
+                return "held"
+            # Expired, or done by an earlier run: only one worker renames it aside
+            stale = f"{path}.{self.worker}.stale"
+            try:
+                os.rename(path, stale)
+            except FileNotFoundError:
+                return "held"
+            if not lease.get("done") and os.stat(stale).st_mtime > time.time() - self.ttl:
+                # Its owner touched it just now after all, so put it back
+                with contextlib.suppress(FileExistsError):
+                    os.link(stale, path)
+                os.unlink(stale)
+                return "held"
+            self.log.info("Taking over the lease of %s from %s", cert_name,
+                          lease.get("worker", "nobody"))
+            os.unlink(stale)
+        return "held"
+
+    def owns(self, path):
+        try:
+            return self._read(path).get("worker") == self.worker
+        except FileNotFoundError:
+            return False
+
+    def holds(self, cert_name, directory="."):
+        """Whether this worker still safely holds the lease of cert_name."""
+        with self.lock:
+            touched = self.held.get(self._path(cert_name, directory))
+        return touched is not None and time.time() - touched < self.ttl * 2 / 3
+
+    def _beat(self):
+        while not self.stopped.wait(self.ttl / 3):
+            with self.lock:
+                held = list(self.held)
+            for path in held:
+                try:
+                    lease = self._read(path)
+                    if lease.get("worker") == self.worker:
+                        os.utime(path)
+                except FileNotFoundError:
+                    # Renamed aside by a worker checking it, which puts it back
+                    continue
+                except OSError as error:
+                    # Such as ESTALE or EIO on a network filesystem; holds()
+                    # gives the lease up if this goes on for too long
+                    self.log.warning("Can't renew lease %s: %s", path, error)
+                    continue
+                with self.lock:
+                    if path not in self.held:
+                        continue
+                    if lease.get("worker") == self.worker:
+                        self.held[path] = time.time()
+                    else:
+                        self.log.warning("Lost lease %s to another worker", path)
+                        del self.held[path]
+
+    def release(self, cert_name, ok=True, directory="."):
+        """Mark cert_name done for this run, whether or not it was issued."""
+        path = self._path(cert_name, directory)
+        with self.lock:
+            self.held.pop(path, None)
+        if self.owns(path):
+            self._write(path, cert_name, done=True, ok=ok)
+
+    def abandon(self, cert_name, directory="."):
+        """Stop holding cert_name without marking it done, so its lease expires."""
+        with self.lock:
+            self.held.pop(self._path(cert_name, directory), None)
+
+    def close(self):
+        self.stopped.set()
+
+
+def _cert_logger(cert_name, directory="."):
+    """Return a logger for one certificate that also writes to <cert_name>.log in directory.
+
+    Its records go through LOGGER tagged with the log file, and only that
+    file's handler takes them, so a long-running daemon adds and removes a
+    handler per certificate rather than leaving a logger behind for each.
+    """
+    path = os.path.abspath(os.path.join(directory, f'{cert_name}.log'))
+    logfile = logging.FileHandler(path)
+    logfile.setFormatter(LOGFORMAT)
+    logfile.addFilter(lambda record: getattr(record, "cert_log", None) == path)
+    LOGGER.addHandler(logfile)
+    log = logging.LoggerAdapter(LOGGER, {"cert_log": path})
+    log.logfile = logfile
+    return log
+
+
+def _close_cert_logger(log):
+    LOGGER.removeHandler(log.logfile)
+    log.logfile.close()
+
+
+def generate_key(key_type, key_file):
+    """Write a new unencrypted PEM private key: RSA 2048 or P-256 ECDSA."""
+    if x509 is None:
+        options = (["-algorithm", "RSA", "-pkeyopt", "rsa_keygen_bits:2048"] if key_type == "rsa"
+                   else ["-algorithm", "EC", "-pkeyopt", "ec_paramgen_curve:P-256"])
+        _openssl("genpkey", options + ["-out", key_file])
+        os.chmod(key_file, 0o600)
+        return
+    key = (rsa.generate_private_key(public_exponent=65537, key_size=2048) if key_type == "rsa"
+           else ec.generate_private_key(ec.SECP256R1()))
+    key_fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(key_fd, "wb") as key_pem:
+        key_pem.write(key.private_bytes(serialization.Encoding.PEM,
+                                        serialization.PrivateFormat.PKCS8,
+                                        serialization.NoEncryption()))
+
+
+def _spool_key(key_type, spool):
+    """Generate a key into the spool directory; runs in a worker process."""
+    name = binascii.hexlify(os.urandom(8)).decode()
+    tmp_file = os.path.join(spool, f".{name}.tmp")
+    generate_key(key_type, tmp_file)
+    os.replace(tmp_file, os.path.join(spool, f"{name}.key"))
+
+
+class KeyPool:
+    """A stock of private keys generated ahead of time in a spool directory.
+
+    take() hands out a key by renaming it inside the spool first, so two
+    runs sharing the spool never get the same key. Every take() tops the
+    stock back up to size in the background, on a pool of processes using
+    all cores; when the stock runs dry a key is generated on the spot.
+    The processes come from a forkserver, since forking this threaded
+    process could copy a lock some other thread holds into them.
+    """
+
+    def __init__(self, spool, key_type="rsa", size=50, workers=None, log=LOGGER):
+        self.spool = os.path.abspath(os.path.join(spool, key_type))
+        os.makedirs(self.spool, mode=0o700, exist_ok=True)
+        self.key_type = key_type
+        self.size = size
+        self.workers = workers or os.cpu_count() or 1
+        self.log = log
+        self.lock = threading.Lock()
+        self.closed = False
+        self.refiller = None
+        self.taken = 0
+        self.missed = 0
+        self.generated = 0
+
+    def stock(self):
+        return [name for name in os.listdir(self.spool) if name.endswith(".key")]
+
+    def refill(self):
+        """Start topping up the stock in the background, unless that is already going on."""
+        with self.lock:
+            if self.closed or (self.refiller and self.refiller.is_alive()):
+                return
+            self.refiller = threading.Thread(target=self._refill, name="key-pool", daemon=True)
+            self.refiller.start()
+
+    def _refill(self):
+        with ProcessPoolExecutor(max_workers=self.workers,
+                                 mp_context=multiprocessing.get_context("forkserver")) as executor:
+            # A round at a time, so close() doesn't wait for the whole stock
+            while not self.closed:
+                missing = self.size - len(self.stock())
+                if missing <= 0:
                     break
-                elif backoff > 128:
-                    log.warning(f"Validation failed after multiple retries")
-                    delete_txt(txt_id,dnsrr_domain)
-                    sys.exit(4)
-                elif challenge_status["status"] == "processing":
-                    log.info("Certificate isn't ready yet - processing "
-                            f", backing off for {backoff}s")
-                    time.sleep(backoff)
-                elif challenge_status["status"] == "pending":
-                    log.info("Certificate isn't ready yet - pending "
-                            f", backing off for {backoff}s")
-                    time.sleep(backoff)
-                elif challenge_status["status"] == "invalid":
-                    log.info("Validation failed, maybe DNS not propogated "
-                            f"yet, backing off for {backoff}s")
-                    log.info(http_response.text)
-                    time.sleep(backoff)
+                for future in [executor.submit(_spool_key, self.key_type, self.spool)
+                               for _ in range(min(missing, self.workers))]:
+                    future.result()
+                    self.generated += 1
+        self.log.debug(f"Key pool {self.spool} refilled to {len(self.stock())}")
+
+    def take(self, key_file):
+        """Move a key from the stock to key_file, generating one if the stock is empty."""
+        claimed = None
+        for name in self.stock():
+            candidate = os.path.join(self.spool, name)
+            claimed = f"{candidate}.{os.getpid()}.{threading.get_ident()}"
+            try:
+                os.rename(candidate, claimed)
+                break
+            except FileNotFoundError:
+                # Someone else took it first
+                claimed = None
+        if claimed:
+            with open(claimed, "rb") as key_pem:
+                key = key_pem.read()
+            key_fd = os.open(key_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(key_fd, "wb") as key_out:
+                key_out.write(key)
+            os.remove(claimed)
+            self.taken += 1
+        else:
+            self.log.info(f"Key pool {self.spool} is empty, generating a key")
+            generate_key(self.key_type, key_file)
+            self.missed += 1
+        self.refill()
+
+    def close(self):
+        """Stop refilling once the keys being generated are done."""
+        with self.lock:
+            self.closed = True
+        if self.refiller:
+            self.refiller.join()
+
+
+def write_csr(cert_name, key_file, csr_file, sans=None):
+    """Write a CSR for cert_name signed with the key in key_file.
+
+    With sans, the CSR is for those names instead, the first as its CN.
+    """
+    common_name = sans[0] if sans else cert_name
+    if x509 is None:
+        _openssl('req',['-new','-key',key_file,'-out',csr_file,
+            '-subj',f'/CN={common_name}',
+            '-addext','extendedKeyUsage = serverAuth, clientAuth']
+            + (['-addext','subjectAltName = ' + ','.join(f'DNS:{san}' for san in sans)]
+               if sans else []))
+        return
+    with open(key_file, "rb") as key_pem:
+        key = serialization.load_pem_private_key(key_pem.read(), password=None)
+    csr = (x509.CertificateSigningRequestBuilder()
+           .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)]))
+           .add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.SERVER_AUTH,
+                                                 ExtendedKeyUsageOID.CLIENT_AUTH]),
+                          critical=False))
+    if sans:
+        csr = csr.add_extension(x509.SubjectAlternativeName([x509.DNSName(san) for san in sans]),
+                                critical=False)
+    csr = csr.sign(key, hashes.SHA256())
+    with open(csr_file, "wb") as csr_pem:
+        csr_pem.write(csr.public_bytes(serialization.Encoding.PEM))
+
+
+def create_csr(cert_name, log=LOGGER, key_type="rsa", key_pool=None, sans=None, directory="."):
+    """Get a key for cert_name, from key_pool if there is one, and write its CSR in directory.
+
+    A key that replaces one already there is staged as <cert_name>.key.new,
+    and only replaces the key in use when store_cert() puts the new
+    certificate next to it; a first key is written as <cert_name>.key
+    straight away, as there is no certificate yet for it not to match.
+    """
+    log.info(f'Creating CSR {cert_name}.csr')
+    key_file = os.path.join(directory, f'{cert_name}.key')
+    if os.path.exists(key_file):
+        key_file += '.new'
+    with METRICS.span("keygen", key_type):
+        if key_pool:
+            key_pool.take(key_file)
+        else:
+            generate_key(key_type, key_file)
+    with METRICS.span("csr"):
+        write_csr(cert_name, key_file, os.path.join(directory, f'{cert_name}.csr'), sans)
+
+
+PEM_CERTIFICATE = re.compile(r"-----BEGIN CERTIFICATE-----[^-]+-----END CERTIFICATE-----")
+
+
+class ArtifactWriter:
+    """Writes each certificate's files atomically, and a manifest of them if asked.
+
+    The chain from the CA is split in-process into the leaf (.cert.pem)
+    and the whole (.fullchain.pem), and with chain set, or a .chain.pem
+    already there, the intermediates (.chain.pem) too if there are any;
+    that is off by default to spare the shared filesystem a file create
+    and rename per certificate. Each is
+    written under a temporary name and fsynced, then they and the key
+    staged by create_csr() are renamed into place one after the other.
+    A reader never sees half a file, but the set is not swapped as one:
+    between the renames it may find the new key next to the old
+    certificate, so one that reads both should re-read on a mismatch.
+    The directories renamed into are fsynced once each by flush(), not
+    after every certificate.
+
+    With manifest_file set, flush() also writes a JSON manifest of every
+    certificate stored: {name: {"fingerprint", "not_after", "paths"}}.
+    """
+
+    def __init__(self):
+        self.manifest_file = None
+        self.chain = False
+        self.lock = threading.Lock()
+        self.directories = set()
+        self.manifest = {}
+
+    def store(self, cert_name, fullchain, key_file=None, directory="."):
+        """Write cert_name's files in directory from the PEM fullchain, and move key_file in."""
+        certs = PEM_CERTIFICATE.findall(fullchain)
+        if not certs:
+            raise ValueError(f"No certificate in the chain received for {cert_name}")
+        paths = {kind: os.path.abspath(os.path.join(directory, f"{cert_name}.{kind}.pem"))
+                 for kind in ("cert", "chain", "fullchain")}
+        pems = {"fullchain": certs, "cert": certs[:1]}
+        # One written before is kept up to date, so it never goes stale next to the rest
+        if len(certs) > 1 and (self.chain or os.path.exists(paths["chain"])):
+            pems["chain"] = certs[1:]
+        else:
+            del paths["chain"]
+        temps = {kind: _write_temp(paths[kind], "".join(f"{cert}\n" for cert in pem_certs))
+                 for kind, pem_certs in pems.items()}
+        paths["key"] = os.path.abspath(os.path.join(directory, f"{cert_name}.key"))
+        # A first key is already in place, and a resumed order may find its
+        # key moved there by the run it was left by
+        if not (key_file and os.path.exists(key_file)):
+            key_file = paths["key"]
+        with open(key_file, "rb") as key_pem:
+            os.fsync(key_pem.fileno())
+        if key_file != paths["key"]:
+            os.replace(key_file, paths["key"])
+        for kind, tmp_path in temps.items():
+            os.replace(tmp_path, paths[kind])
+        der = base64.b64decode("".join(certs[0].splitlines()[1:-1]))
+        with self.lock:
+            self.directories.add(os.path.dirname(paths["cert"]))
+            if self.manifest_file:
+                self.manifest[cert_name] = {"fingerprint": hashlib.sha256(der).hexdigest(),
+                                            "not_after": read_cert(paths["cert"])[0],
+                                            "paths": paths}
+        return paths
+
+    def flush(self):
+        """Make the renames so far durable, and write the manifest if there is one."""
+        with self.lock:
+            directories, self.directories = self.directories, set()
+            manifest = dict(self.manifest)
+        for directory in directories:
+            dir_fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(dir_fd)
+            finally:
+                os.close(dir_fd)
+        if self.manifest_file and manifest:
+            manifest_path = os.path.abspath(self.manifest_file)
+            _atomic_write(manifest_path, json.dumps(manifest, indent=1) + "\n")
+
+
+ARTIFACTS = ArtifactWriter()
+
+
+def store_cert(cert_name, signed_crt, log=LOGGER, directory="."):
+    """Write the certificate chain, leaf, intermediates and new key for cert_name."""
+    with METRICS.span("store"):
+        paths = ARTIFACTS.store(cert_name, signed_crt,
+                                os.path.join(directory, f'{cert_name}.key.new'), directory)
+
+    log.info(f'Finished.')
+    return paths
+
+
+def _prepare_csr(session, cert_name, log=LOGGER, directory="."):
+    """Create a key and CSR for cert_name, unless a journaled order for its CSR is to be resumed."""
+    if session.journal and session.journal.resumable(os.path.join(directory, f'{cert_name}.csr')):
+        log.info(f'Reusing {cert_name}.csr of an interrupted order')
+    else:
+        create_csr(cert_name, log, session.key_type, session.key_pool,
+                   session.packs.get(cert_name), directory)
+
+
+def _finish_cert(session, cert_name, signed_crt, log=LOGGER, directory="."):
+    """Store the certificate, then mark its order finished in the journal."""
+    paths = store_cert(cert_name, signed_crt, log, directory)
+    if session.journal:
+        session.journal.done(os.path.join(directory, f'{cert_name}.csr'))
+    return paths
+
+
+def issue_cert(session, cert_name, log=LOGGER, directory="."):
+    """Create a key and CSR for cert_name in directory, then order and store its certificate.
+
+    Returns the paths of the files written, as ArtifactWriter.store() does.
+    """
+    with METRICS.certificate(cert_name):
+        _prepare_csr(session, cert_name, log, directory)
+        return _finish_cert(session, cert_name,
+                            session.get_crt(os.path.join(directory, f'{cert_name}.csr'), log),
+                            log, directory)
+
+
+def _each(executor, func, cert_names):
+    """Run func(cert_name) for each name, returning {cert_name: (result, error)}."""
+    futures = {cert_name: executor.submit(func, cert_name) for cert_name in cert_names}
+    outcomes = {}
+    for cert_name, future in futures.items():
+        try:
+            outcomes[cert_name] = (future.result(), None)
+        except Exception as error:  # pylint: disable=broad-except
+            outcomes[cert_name] = (None, error)
+    return outcomes
+
+
+def _issue_wave(session, cert_names, testing=False, jobs=1, directory="."):
+    """Issue a wave of names whose authorizations are all done together.
+
+    Orders are created for every name first, then authorize_orders() waits
+    for DNS propagation once across the whole wave before each order is
+    finalized. Returns {cert_name: error or None}.
+    """
+    wave_start = datetime.now()
+    logs = {cert_name: _cert_logger(cert_name, directory) for cert_name in cert_names}
+    errors = {}
+    orders = {}
+
+    def create(cert_name):
+        with METRICS.bind(cert_name):
+            _prepare_csr(session, cert_name, logs[cert_name], directory)
+            order = AcmeOrder(session, os.path.join(directory, f'{cert_name}.csr'),
+                              logs[cert_name])
+            order.step()
+            return order
+
+    def complete(cert_name):
+        with METRICS.bind(cert_name):
+            _finish_cert(session, cert_name, orders[cert_name].run(), logs[cert_name], directory)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+            for cert_name, (order, error) in _each(executor, create, cert_names).items():
+                if error is None:
+                    orders[cert_name] = order
                 else:
-                    raise ValueError(f"Challenge for domain {domain} did not"
-                                     f"pass: {challenge_status}")
+                    errors[cert_name] = error
+            pending = {order: cert_name for cert_name, order in orders.items()
+                       if order.state == 'pending'}
+            with METRICS.span("authorize", "wave"):
+                wave_errors = authorize_orders(list(pending), session)
+            for order, error in wave_errors.items():
+                errors[pending[order]] = error
+            for order in pending:
+                order.state = 'ready'
+            remaining = [cert_name for cert_name in orders if cert_name not in errors]
+            for cert_name, (_, error) in _each(executor, complete, remaining).items():
+                if error is not None:
+                    errors[cert_name] = error
+        for cert_name, error in errors.items():
+            if cert_name in orders:
+                orders[cert_name].release()
+            logs[cert_name].error(f'Failed to get certificate for {cert_name}: {error}')
+    finally:
+        for cert_name in cert_names:
+            METRICS.finish(cert_name, errors.get(cert_name, sys.exc_info()[1]))
+        for log in logs.values():
+            _close_cert_logger(log)
+    if testing:
+        for cert_name in cert_names:
+            if cert_name not in errors:
+                print(f"Got certificate for {cert_name} in {datetime.now()-wave_start}")
+    return {cert_name: errors.get(cert_name) for cert_name in cert_names}
+
+
+def _issue_one(session, cert_name, testing=False, directory="."):
+    """Issue a single batch entry, returning the error it failed with or None."""
+    cert_start = datetime.now()
+    log = _cert_logger(cert_name, directory)
+    try:
+        issue_cert(session, cert_name, log, directory)
+        error = None
+    except Exception as failure:  # pylint: disable=broad-except
+        log.error(f'Failed to get certificate for {cert_name}: {failure}')
+        error = failure
+    finally:
+        _close_cert_logger(log)
+    if testing and error is None:
+        print(f"Got certificate for {cert_name} in {datetime.now()-cert_start}")
+    return error
+
+
+def _run_leased(session, cert_names, leases, testing=False, jobs=1, directory="."):
+    """Issue the names of cert_names this worker gets a lease on.
+
+    A name is only claimed when one of the jobs slots is free, so faster
+    workers take more of the list. Names other workers hold are come back
+    to until they are done or their lease expires and can be taken over;
+    so is a name whose order was abandoned with LeaseLost, which whichever
+    worker takes its lease over next resumes from the journal.
+    Returns {cert_name: error or None} for the names this worker issued.
+    """
+    results = {}
+    slots = threading.BoundedSemaphore(max(jobs, 1))
+    # Workers start at different points of the list, to meet less often
+    offset = (int(hashlib.sha256(leases.worker.encode("utf8")).hexdigest(), 16)
+              % max(len(cert_names), 1))
+    pending = cert_names[offset:] + cert_names[:offset]
+
+    lost = []
+
+    def issue(cert_name):
+        error = None
+        try:
+            error = _issue_one(session, cert_name, testing, directory)
+        finally:
+            if isinstance(error, LeaseLost):
+                leases.abandon(cert_name, directory)
+                lost.append(cert_name)
+            else:
+                results[cert_name] = error
+                leases.release(cert_name, error is None, directory)
+            slots.release()
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        running = set()
+        while pending or running:
+            held = []
+            for cert_name in pending:
+                slots.acquire()
+                state = leases.claim(cert_name, directory)
+                if state == "claimed":
+                    running.add(executor.submit(issue, cert_name))
+                    continue
+                slots.release()
+                if state == "held":
+                    held.append(cert_name)
+            running = {future for future in running if not future.done()}
+            while lost:
+                held.append(lost.pop())
+            if held:
+                LOGGER.debug(f"{len(held)} name(s) leased by other workers, checking again")
+                time.sleep(leases.recheck)
+            elif running:
+                wait(running, return_when=FIRST_COMPLETED)
+            pending = held
+    return results
+
+
+def run_batch(session, cert_names, testing=False, jobs=1, leases=None, directory="."):
+    """Issue every name in cert_names into directory, returning {cert_name: error or None}.
+
+    A failure is logged and recorded against its name rather than ending the
+    run, so one bad name doesn't stop the rest of the batch. Up to jobs
+    orders are kept in flight at once, each advancing on its own thread
+    while the others wait on DNS propagation or ACME polling.
+
+    With a two-phase session the names are instead issued in waves of jobs
+    orders, each wave sharing a single DNS propagation wait.
+
+    With a LeaseManager, the names are shared with other workers instead,
+    one order at a time each; see _run_leased().
+    """
+    if leases:
+        return _run_leased(session, cert_names, leases, testing, jobs, directory)
+    if session.two_phase:
+        results = {}
+        for first in range(0, len(cert_names), max(jobs, 1)):
+            results.update(_issue_wave(session, cert_names[first:first + max(jobs, 1)],
+                                       testing, jobs, directory))
+        return results
+    if jobs <= 1:
+        return {cert_name: _issue_one(session, cert_name, testing, directory)
+                for cert_name in cert_names}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {cert_name: executor.submit(_issue_one, session, cert_name, testing, directory)
+                   for cert_name in cert_names}
+        return {cert_name: future.result() for cert_name, future in futures.items()}
+
+
+def _read_names(source):
+    """Read FQDNs one per line from a file ('-' for stdin), ignoring blanks and comments."""
+    names_file = sys.stdin if source == '-' else open(source)
+    try:
+        return [line.split('#', 1)[0].strip() for line in names_file
+                if line.split('#', 1)[0].strip()]
+    finally:
+        if names_file is not sys.stdin:
+            names_file.close()
+
+
+# Packed certificates are named pack-<digest>.<zone>; this index, kept next
+# to them, tells which pack each name is in
+PACK_INDEX = "acme_certs_packs.json"
+PACK_NAME = re.compile(r"^pack-[0-9a-f]{12}\.")
+
+
+def pack_names(dns, cert_names, size, log=LOGGER):
+    """Group cert_names by DNS zone into certificates of up to size names.
+
+    Returns {pack_name: [names]}, and the names left to go alone: those
+    the DNS provider has no zone for, or alone in theirs. A pack is named
+    after a digest of its names, so the same names make the same pack.
+    """
+    zones = {}
+    single = []
+    for cert_name in cert_names:
+        try:
+            zones.setdefault(dns.zone_for(cert_name, log), []).append(cert_name)
+        except AcmeExit:
+            single.append(cert_name)
+    packs = {}
+    for zone, names in zones.items():
+        names.sort()
+        for first in range(0, len(names), size):
+            group = names[first:first + size]
+            if len(group) == 1:
+                single += group
+                continue
+            digest = hashlib.sha256(",".join(group).encode("utf8")).hexdigest()[:12]
+            packs[f"pack-{digest}.{zone}"] = group
+    return packs, single
+
+
+def load_packs(directory="."):
+    """{pack_name: [names]} of the packs the index in directory has names in."""
+    packs = {}
+    for cert_name, entry in sorted(_read_json(os.path.join(directory, PACK_INDEX)).items()):
+        packs.setdefault(entry["pack"], []).append(cert_name)
+    return packs
+
+
+def save_packs(packs, directory="."):
+    """Point each name of packs at its pack's files in the index in directory.
+
+    The index maps each name to {"pack", "key", "cert", "fullchain"}, and
+    "chain" if that was written, and is updated under a lock, as other
+    workers may be writing it too.
+    """
+    if not packs:
+        return
+    with _update_json(os.path.join(directory, PACK_INDEX), indent=1, sort_keys=True) as index:
+        for pack_name, names in packs.items():
+            files = {kind: os.path.abspath(os.path.join(directory, f"{pack_name}.{kind}.pem"))
+                     for kind in ("cert", "chain", "fullchain")}
+            if not os.path.exists(files["chain"]):
+                del files["chain"]
+            files["key"] = os.path.abspath(os.path.join(directory, f"{pack_name}.key"))
+            for cert_name in names:
+                index[cert_name] = dict(files, pack=pack_name)
+
+
+# Where --serve listens by default, and acme_client.py connects
+DEFAULT_SOCKET = os.path.expanduser("~/.cache/acme_certs.sock")
+# FQDNs the daemon accepts; names end up as file names, so nothing else is let through
+CERT_NAME = re.compile(r"^(\*\.)?([a-z0-9]([a-z0-9-]{0,61}[a-z0-9])?\.)+[a-z]{2,63}$", re.I)
+
+
+class CertDaemon:
+    """Serve certificate requests over a Unix socket from one warm session.
+
+    Each connection sends one JSON line, {"names": [fqdn, ...], "directory":
+    path}, and gets one back, {"results": {fqdn: {"ok": true, "files": {...}}}}
+    with the absolute paths written, or {"ok": false, "code": ..., "error": ...}.
+    {"stats": true} returns the session's counters instead. Up to jobs
+    names are issued at once, into directory (the client's working
+    directory, which has to be an absolute path the daemon can write to)
+    or else the daemon's own; a name asked for again into the same
+    directory while it is in flight shares the order already going.
+    """
+
+    def __init__(self, session, path, jobs=1, log=LOGGER):
+        self.session = session
+        self.path = path
+        self.log = log
+        self.executor = ThreadPoolExecutor(max_workers=max(jobs, 1))
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.requested = self.shared = 0
+        self.server = None
+
+    def submit(self, cert_name, directory="."):
+        """A Future of the error issuing cert_name into directory ended with, or None."""
+        with self.lock:
+            self.requested += 1
+            future = self.in_flight.get((directory, cert_name))
+            if future is None:
+                future = self.executor.submit(self._issue, cert_name, directory)
+                self.in_flight[directory, cert_name] = future
+            else:
+                self.shared += 1
+            return future
+
+    def _issue(self, cert_name, directory):
+        try:
+            return _issue_one(self.session, cert_name, directory=directory)
         finally:
-            delete_txt(txt_id,dnsrr_domain)
+            with self.lock:
+                del self.in_flight[directory, cert_name]
 
-    log.info("Request to finalize the order (all challenges have been completed)")
-    csr_der = _base64(_openssl("req", ["-in", config["acmednstiny"]["CSRFile"],
-                                       "-outform", "DER"]))
-    http_response, result = _send_signed_request(order["finalize"], {"csr": csr_der})
-    if http_response.status_code != 200:
-        raise ValueError("Error while sending the CSR: {0} {1}"
-                         .format(http_response.status_code, result))
+    @staticmethod
+    def _result(cert_name, directory, error):
+        if error is None:
+            files = {kind: os.path.abspath(os.path.join(directory, f"{cert_name}{suffix}"))
+                     for kind, suffix in (("key", ".key"), ("cert", ".cert.pem"),
+                                          ("chain", ".chain.pem"),
+                                          ("fullchain", ".fullchain.pem"))}
+            return {"ok": True, "files": {kind: path for kind, path in files.items()
+                                          if kind != "chain" or os.path.exists(path)}}
+        return {"ok": False, "code": error.code if isinstance(error, AcmeExit) else None,
+                "error": str(error)}
 
-    while True:
-        http_response, order = _send_signed_request(order_location, "")
+    def handle(self, request):
+        """Answer one decoded request."""
+        if not isinstance(request, dict):
+            return {"error": "bad request: not a JSON object"}
+        if request.get("stats"):
+            with self.lock:
+                return {"stats": dict(self.session.stats(), requested=self.requested,
+                                      shared=self.shared, in_flight=len(self.in_flight))}
+        directory = request.get("directory", ".")
+        if directory != "." and not (isinstance(directory, str) and os.path.isabs(directory)
+                                     and os.path.isdir(directory)
+                                     and os.access(directory, os.W_OK | os.X_OK)):
+            return {"error": f"can't write certificates into {directory!r}"}
+        names = request.get("names", [])
+        if not isinstance(names, list):
+            return {"error": "bad request: names is not a list"}
+        bad = [name for name in names if not isinstance(name, str) or not CERT_NAME.match(name)]
+        if bad or not names:
+            return {"error": f"not FQDNs: {bad}" if bad else "no names given"}
+        names = list(dict.fromkeys(names))
+        futures = {name: self.submit(name, directory) for name in names}
+        results = {name: self._result(name, directory, future.result())
+                   for name, future in futures.items()}
+        ARTIFACTS.flush()
+        return {"results": results}
 
-        if order["status"] == "processing":
+    @staticmethod
+    def running(path):
+        """Whether a daemon answers on the socket at path."""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
             try:
-                time.sleep(float(http_response.headers["Retry-After"]))
-            except (OverflowError, ValueError, TypeError):
-                time.sleep(2)
-        elif order["status"] == "valid":
-            log.info("Order finalized!")
-            break
-        else:
-            raise ValueError("Finalizing order {0} got errors: {1}".format(
-                order_location, order))
+                probe.connect(path)
+                return True
+            except OSError:
+                return False
 
-    http_response, result = _send_signed_request(
-        order["certificate"], "",
-        {'Accept': config["acmednstiny"].get("CertificateFormat",
-                                             'application/pem-certificate-chain')})
-    if http_response.status_code != 200:
-        raise ValueError("Finalizing order {0} got errors: {1}"
-                         .format(http_response.status_code, result))
+    def serve(self):
+        """Answer requests until SIGTERM or SIGINT."""
+        daemon = self
 
-    if 'link' in http_response.headers:
-        log.info("  - Certificate links given by server: %s", http_response.headers['link'])
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                line = self.rfile.readline()
+                if not line:
+                    # Closed without asking, as running() does
+                    return
+                try:
+                    response = daemon.handle(json.loads(line))
+                except ValueError as error:
+                    response = {"error": f"bad request: {error}"}
+                except Exception as error:  # pylint: disable=broad-except
+                    # Whatever went wrong, the client gets an answer
+                    daemon.log.exception("Request failed")
+                    response = {"error": f"request failed: {error}"}
+                self.wfile.write(json.dumps(response).encode("utf8") + b"\n")
 
-    log.info("Certificate signed and chain received: %s", order["certificate"])
-    return http_response.text
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        # Only a socket left behind by a daemon that is gone is taken over
+        if self.running(self.path):
+            raise RuntimeError(f"Another daemon is serving on {self.path}")
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(self.path)
+        old_umask = os.umask(0o177)
+        try:
+            self.server = socketserver.ThreadingUnixStreamServer(self.path, Handler)
+        finally:
+            os.umask(old_umask)
+        self.server.daemon_threads = True
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            # shutdown() waits for serve_forever(), so it can't run in this thread
+            signal.signal(signum, lambda *_: threading.Thread(target=self.server.shutdown).start())
+        self.log.info("Serving certificate requests on %s", self.path)
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            os.unlink(self.path)
+            self.executor.shutdown()
 
 
 def main(argv):
@@ -392,19 +3420,130 @@ def main(argv):
         formatter_class=argparse.RawDescriptionHelpFormatter,
         description="Tiny ACME client to get TLS certificate by responding to DNS challenges.",
         epilog="""This script requires access to your private ACME account key and dns server,
-so PLEASE READ THROUGH IT (it won't take too long, it's a one-file script) !
+so PLEASE READ THROUGH IT ! It is one long file; the account key is only
+used by AccountKey, OpensslAccountKey and AcmeSession, and the DNS API token
+only by dns_provider() and DigitalOceanProvider.
 
 Example: requests certificate chain and store it in chain.crt
-  python3 acme_certs.py mydomain.example.com"""
+  python3 acme_certs.py mydomain.example.com
+
+Example: requests certificates for every FQDN listed in names.txt, 20 at a time
+  python3 acme_certs.py --batch names.txt --jobs 20
+
+Example: renews every certificate under /certs expiring within 30 days
+  python3 acme_certs.py --renew /certs --jobs 20"""
     )
+    parser.add_argument("-b","--batch", metavar="FILE",
+                        help="read FQDNs one per line from FILE ('-' for stdin) "
+                        "and get them all with one ACME session")
+    parser.add_argument("--cache", metavar="FILE",
+                        default=os.path.expanduser("~/.cache/acme_certs.json"),
+                        help="keep the ACME directory, account and valid authorizations "
+                        "in FILE between runs (default ~/.cache/acme_certs.json)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="don't read or write the cache")
+    parser.add_argument("--journal", metavar="FILE",
+                        help="journal each order's progress in FILE, so a run that was "
+                        "killed resumes its orders the next time (default "
+                        "~/.cache/acme_certs_journal.jsonl, or journal.jsonl in --lease-dir "
+                        "so a worker taking over a lease resumes its order)")
+    parser.add_argument("--no-journal", action="store_true",
+                        help="don't journal orders, start every one afresh")
+    parser.add_argument("--account-key", metavar="FILE",
+                        help="use this ACME account key instead of the CA's usual one")
+    parser.add_argument("--budget", metavar="FILE",
+                        help="track each CA's rate-limit budget in FILE across runs, holding "
+                        "orders back before the CA would refuse them; kept in "
+                        "~/.cache/acme_certs_budget.json with --limit or several --ca, "
+                        "else off unless this is given")
+    parser.add_argument("--no-budget", action="store_true",
+                        help="don't track rate-limit budgets, even with --limit or several --ca")
+    parser.add_argument("--limit", action="append", metavar="[CA:]KIND=N[/HOURS]",
+                        help="set a rate limit of the budget, for one CA or all of them: "
+                        "KIND is orders (per account), certificates (per registered domain, "
+                        "renewals aside) or failures (per name); e.g. certificates=500/168 "
+                        "after a limit increase (repeatable)")
+    parser.add_argument("--ca", action="append", choices=list(CAS), metavar="NAME",
+                        help="order from this CA; repeat it to spread orders over several "
+                        "by remaining budget, failing over on rate limits "
+                        f"({', '.join(CAS)}; default letsencrypt)")
+    parser.add_argument("--directory", metavar="URL",
+                        help="use the ACME server with this directory URL instead")
+    parser.add_argument("--dns-server", action="append", metavar="HOST[:PORT]",
+                        help="check TXT propagation against this nameserver instead of "
+                        "the zone's authoritative ones (repeatable)")
+    parser.add_argument("--dns-timeout", type=float, default=310, metavar="SECONDS",
+                        help="give up waiting for DNS propagation after SECONDS (default 310)")
+    parser.add_argument("--dns-provider", default="digitalocean", metavar="PROVIDER",
+                        help="where to create TXT records: 'digitalocean[:API_URL]' (default), "
+                        "or 'stub[:FILE]' to keep them in memory or in a JSON file")
+    parser.add_argument("-e","--ecdsa", action="store_true",
+                        help="use P-256 ECDSA certificate keys instead of RSA 2048")
+    parser.add_argument("--key-pool", metavar="DIR",
+                        help="take certificate keys from a stock generated ahead of time "
+                        "in DIR, topped up in the background")
+    parser.add_argument("--key-pool-size", type=int, default=50, metavar="N",
+                        help="keep N keys of each type in the --key-pool stock (default 50)")
+    parser.add_argument("--lease-dir", metavar="DIR",
+                        help="share the names with other workers using the same DIR on a "
+                        "shared filesystem, each name going to whichever claims it first")
+    parser.add_argument("--lease-ttl", type=float, default=300, metavar="SECONDS",
+                        help="take over a lease its worker hasn't renewed for SECONDS; "
+                        "workers of one run should start within that of each other "
+                        "(default 300)")
+    parser.add_argument("--worker-id", metavar="ID",
+                        help="name this worker in --lease-dir (default host.pid)")
+    parser.add_argument("--chain", action="store_true",
+                        help="also write the intermediate certificates to <name>.chain.pem")
+    parser.add_argument("--manifest", metavar="FILE",
+                        help="write a JSON manifest of the certificates stored in this run to "
+                        "FILE: name to SHA-256 fingerprint, notAfter and file paths")
+    parser.add_argument("--metrics", metavar="FILE",
+                        help="append a JSON line per certificate to FILE, with the duration, "
+                        "retries and backoff of every phase and external call")
+    parser.add_argument("--pack", type=int, metavar="N",
+                        help="put up to N names of a batch that share a DNS zone in one "
+                        "multi-SAN certificate (at most 100), recording which pack each "
+                        f"name is in in {PACK_INDEX}")
+    parser.add_argument("--poll-rate", type=float, default=20, metavar="N",
+                        help="poll challenge and order status at most N times a second "
+                        "in all (default 20)")
+    parser.add_argument("--prometheus", metavar="FILE",
+                        help="write histograms of those timings to FILE in the Prometheus "
+                        "text format at the end of the run")
+    parser.add_argument("-j","--jobs", type=int, default=1, metavar="N",
+                        help="keep up to N orders in flight at once (default 1)")
+    parser.add_argument("-o","--openssl", action="store_true",
+                        help="sign requests and parse keys with the openssl command line "
+                        "instead of in-process")
     parser.add_argument("-q","--quiet", action="store_const", const=logging.ERROR,
                         help="show only errors on stderr")
-    parser.add_argument("-r","--root", action="store_true",
-                        help="create a cert for the root of a (sub) domain")
+    # Zones are now looked up from the DNS provider, -r is accepted for old scripts
+    parser.add_argument("-r","--root", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--renew", metavar="DIR",
+                        help="scan DIR for issued <name>.cert.pem/<name>.fullchain.pem files "
+                        "and renew the ones that are due, in place")
+    parser.add_argument("--renew-days", type=float, default=30, metavar="DAYS",
+                        help="renew certificates expiring within DAYS, or sooner if the CA's "
+                        "renewal information suggests it (default 30)")
+    parser.add_argument("--renew-jitter", type=float, default=72, metavar="HOURS",
+                        help="spread renewals up to HOURS earlier, per name (default 72)")
+    parser.add_argument("--renew-index", metavar="FILE",
+                        help="index of scanned certificates (default DIR/.acme_certs_index.json)")
     parser.add_argument("-s","--staging", action="store_true",
                         help="use LetsEncrypt Staging")
+    parser.add_argument("--serve", nargs="?", const=DEFAULT_SOCKET, metavar="SOCKET",
+                        help="stay running and issue certificates asked for over the Unix "
+                        f"socket SOCKET (default {DEFAULT_SOCKET}) into the asking client's "
+                        "working directory, see acme_client.py")
+    parser.add_argument("--sweep", action="store_true",
+                        help="first delete every _acme-challenge TXT record left in the "
+                        "provider's zones; don't run it while anything else is validating")
     parser.add_argument("-t","--testing", action="store_true",
                         help="print timing info for testing")
+    parser.add_argument("--two-phase", action="store_true",
+                        help="create all TXT records of an order (or of each wave of "
+                        "--jobs orders) first, wait for DNS once, then validate them together")
     parser.add_argument("-v","--verbose", action="store_const", const=logging.DEBUG,
                         help="show all debug informations on stderr")
     parser.add_argument("-z","--zerossl", action="store_true",
@@ -413,70 +3552,186 @@ Example: requests certificate chain and store it in chain.crt
                         help="use Google")
     parser.add_argument("-n","--googlestaging", action="store_true",
                         help="use Google Staging")
-    parser.add_argument("cert_name", help="FQDN of certificate to be generated")
+    parser.add_argument("cert_name", nargs="*", help="FQDN of certificate to be generated")
     args = parser.parse_args(argv)
 
-    config = configparser.ConfigParser()
+    cert_names = list(args.cert_name)
+    if args.batch:
+        cert_names += _read_names(args.batch)
+    cert_names = list(dict.fromkeys(cert_names))
+    if not cert_names and not args.renew and not args.sweep and not args.serve:
+        parser.error("at least one cert_name, --batch, --renew, --serve or --sweep is required")
+    if args.pack is not None and not 2 <= args.pack <= 100:
+        parser.error("--pack takes 2 to 100 names per certificate")
+    if args.serve and (cert_names or args.renew):
+        parser.error("--serve takes its names from acme_client.py, not the command line")
 
-    if args.staging:
-        config.read_dict({"acmednstiny":
-            {"accountkeyfile": "/gluster/@/api/keys/letsencrypt.key",
-            "ACMEDirectory": "https://acme-staging-v02.api.letsencrypt.org/directory"}})
-    elif args.zerossl:
-        config.read_dict({"acmednstiny":
-            {"accountkeyfile": "/gluster/@/api/keys/zerossl.key",
-            "ACMEDirectory": "https://acme.zerossl.com/v2/DV90"}})
-    elif args.google:
-        config.read_dict({"acmednstiny":
-            {"accountkeyfile": "/gluster/@/api/keys/google.key",
-            "ACMEDirectory": "https://dv.acme-v02.api.pki.goog/directory"}})
-    elif args.googlestaging:
-        config.read_dict({"acmednstiny":
-            {"accountkeyfile": "/gluster/@/api/keys/google-staging.key",
-            "ACMEDirectory": "https://dv.acme-v02.test-api.pki.goog/directory"}})
-    else:
+    cas = list(dict.fromkeys(args.ca or []))
+    for chosen, ca_name in ((args.staging, "letsencrypt-staging"), (args.zerossl, "zerossl"),
+                            (args.google, "google"), (args.googlestaging, "google-staging")):
+        if chosen and ca_name not in cas:
+            cas.append(ca_name)
+    cas = cas or ["letsencrypt"]
+    if (args.account_key or args.directory) and len(cas) > 1:
+        parser.error("--account-key and --directory only go with a single CA")
+
+    configs = []
+    for ca_name in cas:
+        account_key, directory, _ = CAS[ca_name]
+        config = configparser.ConfigParser()
         config.read_dict({"acmednstiny":
-            {"accountkeyfile": "/gluster/@/api/keys/letsencrypt.key",
-            "ACMEDirectory": "https://acme-v02.api.letsencrypt.org/directory"}})
+            {"CAName": args.directory or ca_name,
+            "AccountKeyFile": args.account_key or account_key,
+            "ACMEDirectory": args.directory or directory}})
 
-    if args.root:
-        global rootdomain
-        rootdomain = True
+        if args.openssl:
+            config.set("acmednstiny", "Signer", "openssl")
+        if not args.no_cache:
+            config.set("acmednstiny", "CacheFile", args.cache)
+        if args.two_phase:
+            config.set("acmednstiny", "TwoPhase", "true")
+        if args.ecdsa:
+            config.set("acmednstiny", "KeyType", "ec")
+        # One key pool serves every CA
+        if args.key_pool and not configs:
+            config.set("acmednstiny", "KeySpool", args.key_pool)
+            config.set("acmednstiny", "KeyPoolSize", str(args.key_pool_size))
+        if args.dns_server:
+            config.set("acmednstiny", "DNSServers", ",".join(args.dns_server))
+        config.set("acmednstiny", "DNSTimeout", str(args.dns_timeout))
+        config.set("acmednstiny", "DNSProvider", args.dns_provider)
+        config.set("acmednstiny", "PollRate", str(args.poll_rate))
+        configs.append(config)
 
-    logformat = logging.Formatter("%(asctime)s:%(levelname)s:%(message)s")
-    logfile = logging.FileHandler(f'{args.cert_name}.log')
-    logfile.setFormatter(logformat)
+    # A --directory of our own has no known limits but those given, else only 429s hold it back
+    limits = ({args.directory: {}} if args.directory
+              else {CAS[ca_name][1]: dict(CAS[ca_name][2]) for ca_name in cas})
+    for spec in args.limit or []:
+        match = LIMIT_SPEC.match(spec)
+        if not match or (match.group(1) and match.group(1) not in cas):
+            parser.error(f"--limit {spec}: expected [CA:]KIND=N[/HOURS] for a CA in use")
+        ca_name, kind, count, hours = match.groups()
+        for directory, ca_limits in limits.items():
+            if ca_name and not args.directory and directory != CAS[ca_name][1]:
+                continue
+            window = (float(hours) * 3600 if hours
+                      else ca_limits.get(kind, LE_LIMITS[kind])[1])
+            ca_limits[kind] = (int(count), window)
+    # Off for a plain run, so an account with raised limits isn't held to the published ones
+    budget = None
+    if not args.no_budget and (args.budget or args.limit or len(cas) > 1):
+        budget = BudgetTracker(args.budget or os.path.expanduser(
+            "~/.cache/acme_certs_budget.json"), limits)
 
-    LOGGER.addHandler(logfile)
+    journal_file = args.journal or (
+        os.path.join(args.lease_dir, "journal.jsonl") if args.lease_dir
+        else os.path.expanduser("~/.cache/acme_certs_journal.jsonl"))
+    journal = None if args.no_journal else OrderJournal(journal_file)
+    leases = args.lease_dir and LeaseManager(args.lease_dir, args.worker_id, args.lease_ttl)
 
     logstream = logging.StreamHandler()
     logstream.setLevel(args.verbose or args.quiet or logging.INFO)
-    logstream.setFormatter(logformat)
+    logstream.setFormatter(LOGFORMAT)
 
     LOGGER.addHandler(logstream)
 
-    # Generate a Certificate Signing Request (CSR) using OpenSSL
-    LOGGER.info(f'Creating CSR {args.cert_name}.csr')
-    _openssl('req',['-new','-newkey','rsa:2048','-nodes',
-        '-out',f'{args.cert_name}.csr','-keyout',f'{args.cert_name}.key',
-        '-subj',f'/CN={args.cert_name}',
-        '-addext','extendedKeyUsage = serverAuth, clientAuth'])
-    config.set("acmednstiny", "csrfile", f"{args.cert_name}.csr")
-
-    if (set(["csrfile", "acmedirectory"]) - set(config.options("acmednstiny"))):
-        raise ValueError("Some required settings are missing.")
-    signed_crt = get_crt(config, LOGGER)
-    cert_file = open(f'{args.cert_name}.fullchain.pem', 'w')
-    cert_file.write(signed_crt)
-    cert_file.close()
-
-    LOGGER.info(f'Extracting cert from fullchain')
-    _openssl('x509', ['-in',f'{args.cert_name}.fullchain.pem','-outform',
-        'PEM','-out',f'{args.cert_name}.cert.pem'])
-
-    LOGGER.info(f'Finished.')
-    if args.testing:
-        print(f"Got certificate for {args.cert_name} in {datetime.now()-start}")
+    METRICS.jsonl_file = args.metrics
+    ARTIFACTS.manifest_file = args.manifest
+    ARTIFACTS.chain = args.chain
+    try:
+        if args.sweep:
+            swept = dns_provider(args.dns_provider).sweep(log=LOGGER)
+            print(f"Swept {swept} _acme-challenge TXT record(s)")
+            if not cert_names and not args.renew and not args.serve:
+                return
+
+        if args.serve:
+            if CertDaemon.running(args.serve):
+                parser.error(f"--serve {args.serve}: another daemon is serving on it")
+            session = open_session(configs, LOGGER, args.jobs, budget, journal)
+            try:
+                CertDaemon(session, args.serve, args.jobs).serve()
+            finally:
+                session.close()
+            session.log_stats()
+            return
+        if args.renew:
+            session = open_session(configs, LOGGER, args.jobs, budget, journal, leases)
+            try:
+                scheduler = RenewalScheduler(args.renew, args.renew_index, args.renew_days,
+                                             args.renew_jitter, session.http,
+                                             session.acme_config.get("renewalInfo"),
+                                             "openssl" if args.openssl else "auto")
+                due = scheduler.due()
+                # Certificates are renewed where they were found, one directory at a time
+                results = {}
+                for directory in dict.fromkeys(entry["dir"] for entry in due):
+                    # A pack no name is in any more has been replaced, so it lapses
+                    packs = load_packs(directory)
+                    session.packs.update(packs)
+                    results.update(run_batch(session, [entry["name"] for entry in due
+                                                       if entry["dir"] == directory
+                                                       and (entry["name"] in packs
+                                                            or not PACK_NAME.match(entry["name"]))],
+                                             args.testing, args.jobs, leases, directory))
+                results.update(run_batch(session, [name for name in cert_names
+                                                   if name not in results],
+                                         args.testing, args.jobs, leases))
+            finally:
+                session.close()
+        elif len(cert_names) == 1 and not args.batch and not leases and not args.pack:
+            # Single certificate: account setup is logged to <cert_name>.log too,
+            # and failures end the run with their own exit code
+            log = _cert_logger(cert_names[0])
+            session = open_session(configs, log, 1, budget, journal)
+            try:
+                issue_cert(session, cert_names[0], log)
+            except AcmeExit as error:
+                sys.exit(error.code)
+            finally:
+                session.close()
+            session.log_stats()
+            if args.testing:
+                print(f"Got certificate for {cert_names[0]} in {datetime.now()-start}")
+            return
+        else:
+            session = open_session(configs, LOGGER, args.jobs, budget, journal, leases)
+            try:
+                packs, names = ({}, cert_names) if not args.pack else pack_names(
+                    session.dns, cert_names, args.pack)
+                session.packs.update(packs)
+                results = run_batch(session, list(packs) + names, args.testing, args.jobs,
+                                    leases)
+                save_packs({pack_name: packed for pack_name, packed in packs.items()
+                            if pack_name in results and results[pack_name] is None})
+                # Each packed name is reported with its pack's outcome
+                for pack_name, packed in packs.items():
+                    if pack_name in results:
+                        error = results.pop(pack_name)
+                        results.update((cert_name, error) for cert_name in packed)
+            finally:
+                session.close()
+        session.log_stats()
+
+        failed = [name for name, error in results.items() if error is not None]
+        for cert_name, error in results.items():
+            if error is None:
+                print(f"OK {cert_name}")
+            else:
+                code = error.code if isinstance(error, AcmeExit) else 'error'
+                print(f"FAILED {cert_name} ({code}): {error}")
+        if args.testing:
+            print(f"Got {len(results)-len(failed)} of {len(results)} certificates "
+                  f"in {datetime.now()-start}")
+        if failed:
+            sys.exit(5)
+    finally:
+        if leases:
+            leases.close()
+        ARTIFACTS.flush()
+        METRICS.flush_unbound()
+        if args.prometheus:
+            METRICS.write_prometheus(args.prometheus)
 
 if __name__ == "__main__":  # pragma: no cover
     main(sys.argv[1:])
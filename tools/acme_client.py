@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# pylint: disable=multiple-imports
+"""Ask a running `acme_certs.py --serve` daemon for certificates.
+
+Takes the same names and --batch as acme_certs.py and answers the same way:
+the files are written into the working directory, a single name exits
+with its failure's exit code, a batch prints OK/FAILED per name and exits
+5 if any failed. The paths written are printed too, one "KIND PATH" line
+each. Only the standard library is imported, so a call costs little more
+than the round trip and the ACME work itself.
+"""
+import argparse, json, os, socket, sys
+
+DEFAULT_SOCKET = os.path.expanduser("~/.cache/acme_certs.sock")
+
+
+def request(path, message):
+    """Send one JSON request to the daemon at path and return its answer."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(path)
+        connection.sendall(json.dumps(message).encode("utf8") + b"\n")
+        with connection.makefile("rb") as answer:
+            line = answer.readline()
+    if not line:
+        return {"error": "the daemon closed the connection without answering"}
+    return json.loads(line)
+
+
+def _print_files(result, indent=""):
+    """Print the paths a certificate was written to, one "KIND PATH" line each."""
+    for kind, path in result["files"].items():
+        print(f"{indent}{kind} {path}")
+
+
+def _read_names(source):
+    """Read FQDNs one per line from a file ('-' for stdin), ignoring blanks and comments."""
+    names_file = sys.stdin if source == '-' else open(source)
+    try:
+        return [line.split('#', 1)[0].strip() for line in names_file
+                if line.split('#', 1)[0].strip()]
+    finally:
+        if names_file is not sys.stdin:
+            names_file.close()
+
+
+def main(argv):
+    """Parse arguments and get certificates from the daemon."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-b","--batch", metavar="FILE",
+                        help="read FQDNs one per line from FILE ('-' for stdin)")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, metavar="SOCKET",
+                        help=f"the daemon's Unix socket (default {DEFAULT_SOCKET})")
+    parser.add_argument("--stats", action="store_true",
+                        help="print the daemon's counters as JSON instead")
+    parser.add_argument("cert_name", nargs="*", help="FQDN of certificate to be generated")
+    args = parser.parse_args(argv)
+
+    if args.stats:
+        print(json.dumps(request(args.socket, {"stats": True})["stats"], indent=1))
+        return
+    cert_names = list(args.cert_name)
+    if args.batch:
+        cert_names += _read_names(args.batch)
+    cert_names = list(dict.fromkeys(cert_names))
+    if not cert_names:
+        parser.error("at least one cert_name or --batch is required")
+
+    answer = request(args.socket, {"names": cert_names, "directory": os.getcwd()})
+    if "error" in answer:
+        sys.exit(answer["error"])
+    results = answer["results"]
+    if len(cert_names) == 1 and not args.batch:
+        result = results[cert_names[0]]
+        if not result["ok"]:
+            print(f"Failed to get certificate for {cert_names[0]}: {result['error']}",
+                  file=sys.stderr)
+            sys.exit(result["code"] or 1)
+        _print_files(result)
+        return
+    for cert_name, result in results.items():
+        if result["ok"]:
+            print(f"OK {cert_name}")
+            _print_files(result, "  ")
+        else:
+            print(f"FAILED {cert_name} ({result['code'] or 'error'}): {result['error']}")
+    if not all(result["ok"] for result in results.values()):
+        sys.exit(5)
+
+if __name__ == "__main__":  # pragma: no cover
+    main(sys.argv[1:])
@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+# pylint: disable=multiple-imports
+"""Local stand-ins for an ACME CA, the DigitalOcean DNS API and authoritative DNS.
+
+They let acme_bench.py drive acme_certs.py end to end without touching a
+real CA, DigitalOcean or the DNS. Each one starts on an ephemeral port on
+127.0.0.1, in daemon threads, and counts the requests it served.
+
+Needs `pip3 install cryptography dnspython`.
+"""
+import base64, datetime, itertools, json, os, random, socket, threading, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import dns.flags, dns.message, dns.rcode, dns.rrset
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec, padding, rsa, utils
+from cryptography.x509.oid import NameOID
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).decode("utf8").rstrip("=")
+
+
+def _int(text):
+    return int.from_bytes(_b64decode(text), "big")
+
+
+class _Server:
+    """A ThreadingHTTPServer on 127.0.0.1 serving a handler class."""
+
+    def __init__(self, handler):
+        self.lock = threading.RLock()
+        self.requests = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def count(self):
+        with self.lock:
+            self.requests += 1
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """JSON over keep-alive HTTP/1.1, quietly."""
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body go out in separate writes, which Nagle would delay by ~40ms
+    disable_nagle_algorithm = True
+    owner = None
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+    def send(self, code, body=None, headers=None, content_type="application/json"):
+        data = b"" if body is None else (body if isinstance(body, bytes)
+                                         else json.dumps(body).encode("utf8"))
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def body(self):
+        return json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"null")
+
+
+class MockCA(_Server):
+    """An RFC 8555 CA issuing for dns-01 challenges without checking DNS.
+
+    Every request is delayed by latency seconds. JWS signatures (RS256 and
+    ES256), nonces and URLs are checked as a real CA would. Errors can be
+    injected: a rate_limit share of signed requests get 429 with
+    Retry-After, a bad_nonce share get badNonce. Challenges and finalized
+    orders stay 'processing' for processing_polls polls, advertising
+    retry_after. Valid authorizations are reused by later orders of the same
+    account, and ARI suggests renewing between 30 and 28 days before expiry.
+    """
+
+    def __init__(self, latency=0.0, rate_limit=0.0, bad_nonce=0.0, processing_polls=1,
+                 retry_after=0):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.bad_nonce = bad_nonce
+        self.processing_polls = processing_polls
+        self.retry_after = retry_after
+        self.ids = itertools.count(1)
+        self.nonces = set()
+        self.accounts = {}
+        self.orders, self.authzs, self.challenges, self.certs = {}, {}, {}, {}
+        # Valid authz by (kid, identifier type, value), and the orders of each authz,
+        # so neither a new order nor a validation scans everything issued so far
+        self.valid_authzs, self.authz_orders = {}, {}
+        # notAfter of each issued certificate by ARI certID
+        self.issued = {}
+        self.key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "Mock CA")])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        self.cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name)
+                     .public_key(self.key.public_key()).serial_number(1)
+                     .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=3650))
+                     .sign(self.key, hashes.SHA256()))
+        super().__init__(type("CAHandler", (_CAHandler,), {"owner": self}))
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    @property
+    def directory(self):
+        return f"{self.url}/directory"
+
+    def new_nonce(self):
+        nonce = _b64encode(os.urandom(12))
+        with self.lock:
+            self.nonces.add(nonce)
+        return nonce
+
+    def use_nonce(self, nonce):
+        with self.lock:
+            if nonce in self.nonces:
+                self.nonces.discard(nonce)
+                return True
+        return False
+
+    def issue(self, csr_der, names):
+        """PEM chain for a CSR, valid 90 days, with an AKI so ARI certIDs work."""
+        csr = x509.load_der_x509_csr(csr_der)
+        now = datetime.datetime.now(datetime.timezone.utc)
+        serial = x509.random_serial_number()
+        key_id = x509.AuthorityKeyIdentifier.from_issuer_public_key(self.key.public_key())
+        cert = (x509.CertificateBuilder().subject_name(csr.subject)
+                .issuer_name(self.cert.subject).public_key(csr.public_key())
+                .serial_number(serial)
+                .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=90))
+                .add_extension(x509.SubjectAlternativeName([x509.DNSName(name)
+                                                            for name in names]), False)
+                .add_extension(key_id, False)
+                .sign(self.key, hashes.SHA256()))
+        cert_id = "{0}.{1}".format(_b64encode(key_id.key_identifier),
+                                   _b64encode(serial.to_bytes(serial.bit_length() // 8 + 1, "big")))
+        self.issued[cert_id] = now + datetime.timedelta(days=90)
+        return (cert.public_bytes(serialization.Encoding.PEM)
+                + self.cert.public_bytes(serialization.Encoding.PEM))
+
+
+def _verify(jwk, signing_input, signature):
+    """Raise unless signature is a valid RS256 or ES256 JWS signature by jwk."""
+    if jwk["kty"] == "RSA":
+        public_key = rsa.RSAPublicNumbers(_int(jwk["e"]), _int(jwk["n"])).public_key()
+        public_key.verify(signature, signing_input, padding.PKCS1v15(), hashes.SHA256())
+    else:
+        public_key = ec.EllipticCurvePublicNumbers(_int(jwk["x"]), _int(jwk["y"]),
+                                                   ec.SECP256R1()).public_key()
+        half = len(signature) // 2
+        public_key.verify(utils.encode_dss_signature(int.from_bytes(signature[:half], "big"),
+                                                     int.from_bytes(signature[half:], "big")),
+                          signing_input, ec.ECDSA(hashes.SHA256()))
+
+
+class _CAHandler(_Handler):
+
+    def send(self, code, body=None, headers=None, content_type="application/json"):
+        headers = dict(headers or {}, **{"Replay-Nonce": self.owner.new_nonce()})
+        super().send(code, body, headers, content_type)
+
+    def error(self, code, error_type, detail, headers=None):
+        self.send(code, {"type": "urn:ietf:params:acme:error:" + error_type, "detail": detail},
+                  headers, "application/problem+json")
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        self.owner.count()
+        self.send(200)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        ca = self.owner
+        ca.count()
+        time.sleep(ca.latency)
+        if self.path == "/directory":
+            self.send(200, {"newNonce": f"{ca.url}/new-nonce",
+                            "newAccount": f"{ca.url}/new-account",
+                            "newOrder": f"{ca.url}/new-order",
+                            "renewalInfo": f"{ca.url}/renewal-info",
+                            "meta": {"termsOfService": f"{ca.url}/terms"}})
+        elif self.path.startswith("/renewal-info/"):
+            not_after = ca.issued.get(self.path.rsplit("/", 1)[1])
+            if not_after is None:
+                return self.error(404, "malformed", "unknown certificate")
+            window = [(not_after - datetime.timedelta(days=days)).strftime("%Y-%m-%dT%H:%M:%SZ")
+                      for days in (30, 28)]
+            self.send(200, {"suggestedWindow": {"start": window[0], "end": window[1]}},
+                      {"Retry-After": "21600"})
+        elif self.path == "/new-nonce":
+            self.send(204)
+        else:
+            self.error(404, "malformed", "not found")
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        ca = self.owner
+        ca.count()
+        time.sleep(ca.latency)
+        jws = self.body()
+        protected = json.loads(_b64decode(jws["protected"]))
+        if random.random() < ca.rate_limit:
+            return self.error(429, "rateLimited", "too many requests", {"Retry-After": "1"})
+        if not ca.use_nonce(protected.get("nonce")) or random.random() < ca.bad_nonce:
+            return self.error(400, "badNonce", "bad nonce")
+        if protected.get("url") != ca.url + self.path:
+            return self.error(401, "unauthorized", "url mismatch")
+        jwk = protected.get("jwk") or ca.accounts.get(protected.get("kid"))
+        if jwk is None:
+            return self.error(400, "accountDoesNotExist", "no such account")
+        try:
+            _verify(jwk, f'{jws["protected"]}.{jws["payload"]}'.encode("utf8"),
+                    _b64decode(jws["signature"]))
+        except Exception:  # pylint: disable=broad-except
+            return self.error(400, "malformed", "bad signature")
+        payload = json.loads(_b64decode(jws["payload"])) if jws["payload"] else ""
+        kind, _, number = self.path[1:].partition("/")
+        handler = getattr(self, "post_" + kind.replace("-", "_"), None)
+        if handler is None:
+            return self.error(404, "malformed", "not found")
+        with ca.lock:
+            respond = handler(int(number) if number.isdigit() else None, payload, protected, jwk)
+        return respond()
+
+    def reply(self, *args, **kwargs):
+        """A send() to make once the CA's lock is released."""
+        return lambda: self.send(*args, **kwargs)
+
+    def reply_error(self, *args, **kwargs):
+        return lambda: self.error(*args, **kwargs)
+
+    def post_new_account(self, _, payload, protected, jwk):
+        ca = self.owner
+        for kid, account_jwk in ca.accounts.items():
+            if account_jwk == jwk:
+                return self.reply(200, {"status": "valid", "contact": []}, {"Location": kid})
+        kid = f"{ca.url}/account/{next(ca.ids)}"
+        ca.accounts[kid] = jwk
+        return self.reply(201, {"status": "valid", "contact": payload.get("contact", [])},
+                         {"Location": kid})
+
+    def post_account(self, _, payload, protected, jwk):
+        return self.reply(200, {"status": "valid",
+                               "contact": payload.get("contact", []) if payload else []})
+
+    def post_new_order(self, _, payload, protected, jwk):
+        ca = self.owner
+        order_id = next(ca.ids)
+        authzs = []
+        for identifier in payload["identifiers"]:
+            reusable = ca.valid_authzs.get((protected.get("kid"), identifier["type"],
+                                            identifier["value"]))
+            if reusable is not None:
+                authzs.append(reusable)
+                continue
+            authz_id, challenge_id = next(ca.ids), next(ca.ids)
+            ca.challenges[challenge_id] = {
+                "type": "dns-01", "url": f"{ca.url}/challenge/{challenge_id}",
+                "token": _b64encode(os.urandom(16)), "status": "pending",
+                "polls": 0, "authz": authz_id}
+            ca.authzs[authz_id] = {"identifier": identifier, "status": "pending",
+                                   "challenges": [challenge_id],
+                                   "expires": "2099-01-01T00:00:00Z",
+                                   "kid": protected.get("kid")}
+            authzs.append(authz_id)
+        for authz_id in authzs:
+            ca.authz_orders.setdefault(authz_id, []).append(order_id)
+        ca.orders[order_id] = {"status": "pending", "authzs": authzs,
+                               "identifiers": payload["identifiers"], "polls": 0}
+        self._update_order(order_id)
+        return self.reply(201, self._order(order_id), {"Location": f"{ca.url}/order/{order_id}"})
+
+    def post_authz(self, authz_id, payload, protected, jwk):
+        authz = self.owner.authzs[authz_id]
+        return self.reply(200, {"identifier": authz["identifier"], "status": authz["status"],
+                               "expires": authz["expires"],
+                               "challenges": [self._challenge(challenge_id)
+                                              for challenge_id in authz["challenges"]]})
+
+    def post_challenge(self, challenge_id, payload, protected, jwk):
+        ca = self.owner
+        challenge = ca.challenges[challenge_id]
+        if payload == {} and challenge["status"] == "pending":
+            challenge["status"] = "processing"
+        elif challenge["status"] == "processing":
+            challenge["polls"] += 1
+            if challenge["polls"] >= ca.processing_polls:
+                challenge["status"] = "valid"
+                authz = ca.authzs[challenge["authz"]]
+                authz["status"] = "valid"
+                ca.valid_authzs.setdefault((authz["kid"], authz["identifier"]["type"],
+                                            authz["identifier"]["value"]), challenge["authz"])
+                for order_id in ca.authz_orders.get(challenge["authz"], []):
+                    self._update_order(order_id)
+        headers = ({"Retry-After": str(ca.retry_after)} if challenge["status"] == "processing"
+                   else {})
+        return self.reply(200, self._challenge(challenge_id), headers)
+
+    def post_finalize(self, order_id, payload, protected, jwk):
+        ca = self.owner
+        order = ca.orders[order_id]
+        if order["status"] != "ready":
+            return self.reply_error(403, "orderNotReady", "order is not ready")
+        ca.certs[order_id] = ca.issue(_b64decode(payload["csr"]),
+                                      [identifier["value"] for identifier in order["identifiers"]])
+        order["status"] = "processing"
+        return self.reply(200, self._order(order_id))
+
+    def post_order(self, order_id, payload, protected, jwk):
+        ca = self.owner
+        order = ca.orders[order_id]
+        if order["status"] == "processing":
+            order["polls"] += 1
+            if order["polls"] >= ca.processing_polls:
+                order["status"] = "valid"
+            else:
+                return self.reply(200, self._order(order_id),
+                                 {"Retry-After": str(ca.retry_after)})
+        return self.reply(200, self._order(order_id))
+
+    def post_certificate(self, order_id, payload, protected, jwk):
+        return self.reply(200, self.owner.certs[order_id],
+                         content_type="application/pem-certificate-chain")
+
+    def _update_order(self, order_id):
+        ca = self.owner
+        order = ca.orders[order_id]
+        if order["status"] == "pending" and all(ca.authzs[authz_id]["status"] == "valid"
+                                                for authz_id in order["authzs"]):
+            order["status"] = "ready"
+
+    def _order(self, order_id):
+        ca = self.owner
+        order = ca.orders[order_id]
+        view = {"status": order["status"], "identifiers": order["identifiers"],
+                "authorizations": [f"{ca.url}/authz/{authz_id}" for authz_id in order["authzs"]],
+                "finalize": f"{ca.url}/finalize/{order_id}"}
+        if order["status"] == "valid":
+            view["certificate"] = f"{ca.url}/certificate/{order_id}"
+        return view
+
+    def _challenge(self, challenge_id):
+        challenge = self.owner.challenges[challenge_id]
+        return {key: challenge[key] for key in ("type", "url", "token", "status")}
+
+
+class MockDO(_Server):
+    """The DigitalOcean v2 domains and records API, for the given zones.
+
+    Listings are paginated like the real API. A rate_limit share of
+    requests get 429 with RateLimit headers, and every request is delayed
+    by latency seconds.
+    """
+
+    PAGE = 20
+
+    def __init__(self, zones=("example.com",), latency=0.0, rate_limit=0.0):
+        self.zones = list(zones)
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.records = {}
+        self.ids = itertools.count(1000)
+        super().__init__(type("DOHandler", (_DOHandler,), {"owner": self}))
+        self.url = f"http://127.0.0.1:{self.server.server_port}/v2/"
+
+    def lookup(self, name, age=0.0):
+        """TXT values for name, from records created at least age seconds ago."""
+        now = time.time()
+        with self.lock:
+            return [record["data"] for record in self.records.values()
+                    if f'{record["name"]}.{record["zone"]}' == name
+                    and now - record["created"] >= age]
+
+
+class _DOHandler(_Handler):
+
+    def _start(self):
+        """Count and delay the request; False when it was rate limited."""
+        owner = self.owner
+        owner.count()
+        time.sleep(owner.latency)
+        if random.random() < owner.rate_limit:
+            self.send(429, {"id": "too_many_requests", "message": "API Rate limit exceeded."},
+                      {"RateLimit-Remaining": "0", "RateLimit-Reset": str(int(time.time()) + 1)})
+            return False
+        return True
+
+    def _page(self, key, items):
+        query = dict(part.split("=", 1) for part in self.path.partition("?")[2].split("&")
+                     if "=" in part)
+        page, per_page = int(query.get("page", 1)), int(query.get("per_page", self.owner.PAGE))
+        links = {}
+        if page * per_page < len(items):
+            links = {"pages": {"next": f"{self.owner.url}?page={page + 1}"}}
+        self.send(200, {key: items[(page - 1) * per_page:page * per_page], "links": links,
+                        "meta": {"total": len(items)}})
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        if not self._start():
+            return
+        path = self.path.partition("?")[0].split("/")
+        owner = self.owner
+        if path[2:] == ["domains"]:
+            return self._page("domains", [{"name": zone} for zone in owner.zones])
+        if len(path) == 5 and path[4] == "records" and path[3] in owner.zones:
+            with owner.lock:
+                records = [dict(record) for record in owner.records.values()
+                           if record["zone"] == path[3]]
+            return self._page("domain_records", records)
+        return self.send(404, {"id": "not_found", "message": "not found"})
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        body = self.body()
+        if not self._start():
+            return
+        owner = self.owner
+        zone = self.path.split("/")[3]
+        if zone not in owner.zones:
+            return self.send(404, {"id": "not_found", "message": "not found"})
+        with owner.lock:
+            record = dict(body, id=next(owner.ids), zone=zone, created=time.time())
+            owner.records[record["id"]] = record
+        return self.send(201, {"domain_record": record})
+
+    def do_DELETE(self):  # pylint: disable=invalid-name
+        if not self._start():
+            return
+        with self.owner.lock:
+            found = self.owner.records.pop(int(self.path.rsplit("/", 1)[1]), None)
+        if found is None:
+            return self.send(404, {"id": "not_found", "message": "not found"})
+        return self.send(204)
+
+
+class StubDNS:
+    """An authoritative DNS server on UDP answering TXT queries from lookup(name, delay).
+
+    delay simulates propagation: a record is only served once it is that
+    many seconds old.
+    """
+
+    def __init__(self, lookup, delay=0.0):
+        self.lookup = lookup
+        self.delay = delay
+        self.queries = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(("127.0.0.1", 0))
+        self.address = "127.0.0.1:{0}".format(self.sock.getsockname()[1])
+
+    def start(self):
+        threading.Thread(target=self.serve, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.sock.close()
+
+    def serve(self):
+        while True:
+            try:
+                wire, peer = self.sock.recvfrom(4096)
+            except OSError:
+                return
+            self.queries += 1
+            query = dns.message.from_wire(wire)
+            response = dns.message.make_response(query)
+            response.flags |= dns.flags.AA
+            question = query.question[0]
+            values = self.lookup(question.name.to_text().rstrip("."), self.delay)
+            if values:
+                response.answer.append(dns.rrset.from_text(
+                    question.name, 60, "IN", "TXT", *['"{0}"'.format(value) for value in values]))
+            else:
+                response.set_rcode(dns.rcode.NXDOMAIN)
+            self.sock.sendto(response.to_wire(), peer)
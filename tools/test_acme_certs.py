@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# pylint: disable=multiple-imports
+"""Tests of acme_certs.py's crash recovery and shared state, against acme_mock's stand-ins.
+
+Run with `python3 -m unittest test_acme_certs` (or pytest) from this directory;
+acme_mock needs `pip3 install cryptography`.
+"""
+import configparser, errno, json, os, signal, subprocess, sys, tempfile, time, unittest
+from unittest import mock
+
+import acme_certs, acme_mock
+
+CERTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "acme_certs.py")
+
+
+class MockTestCase(unittest.TestCase):
+    """A mock CA, DigitalOcean API and authoritative DNS, and an account key in a work dir."""
+
+    def setUp(self):
+        self.ca = acme_mock.MockCA().start()
+        self.do_api = acme_mock.MockDO(("example.com",)).start()
+        self.stub = acme_mock.StubDNS(self.do_api.lookup).start()
+        self.work = tempfile.mkdtemp(prefix="acme_certs_test")
+        self.account_key = os.path.join(self.work, "account.key")
+        acme_certs.generate_key("rsa", self.account_key)
+        self.journal_file = os.path.join(self.work, "journal.jsonl")
+
+    def tearDown(self):
+        self.ca.stop()
+        self.do_api.stop()
+        self.stub.stop()
+
+    def argv(self, *extra):
+        return [sys.executable, CERTS, "--directory", self.ca.directory,
+                "--account-key", self.account_key,
+                "--dns-provider", f"digitalocean:{self.do_api.url}",
+                "--dns-server", self.stub.address, "--no-cache",
+                "--journal", self.journal_file, "--quiet"] + list(extra)
+
+    def session(self, **kwargs):
+        config = configparser.ConfigParser()
+        config.read_dict({"acmednstiny": {
+            "CAName": "mock", "AccountKeyFile": self.account_key,
+            "ACMEDirectory": self.ca.directory, "DNSServers": self.stub.address,
+            "DNSProvider": f"digitalocean:{self.do_api.url}"}})
+        session = acme_certs.open_session([config], **kwargs)
+        self.addCleanup(session.close)
+        return session
+
+
+class OrderJournalTest(MockTestCase):
+
+    def test_resume_after_kill_mid_authorization(self):
+        # Records are only served after a while, so the first run is stuck waiting on them
+        self.stub.delay = 60
+        first = subprocess.Popen(self.argv("a.example.com"), cwd=self.work)
+        deadline = time.monotonic() + 30
+        while not self.do_api.records and time.monotonic() < deadline:
+            time.sleep(0.1)
+        time.sleep(0.5)
+        first.send_signal(signal.SIGKILL)
+        first.wait()
+        self.assertEqual(len(self.ca.orders), 1)
+        self.assertEqual(len(self.do_api.records), 1)
+
+        self.stub.delay = 0
+        second = subprocess.run(self.argv("a.example.com"), cwd=self.work,
+                                capture_output=True, text=True)
+        self.assertEqual(second.returncode, 0, second.stderr)
+        self.assertEqual(len(self.ca.orders), 1, "the interrupted order wasn't resumed")
+        self.assertEqual(self.do_api.records, {}, "TXT records were left behind")
+        with open(os.path.join(self.work, "a.example.com.log")) as log:
+            self.assertIn("Resume order", log.read())
+        self.assertTrue(os.path.exists(os.path.join(self.work, "a.example.com.fullchain.pem")))
+        self.assertEqual(acme_certs.OrderJournal(self.journal_file).entries, {})
+
+    def test_truncated_line(self):
+        csr_file = os.path.join(self.work, "a.example.com.csr")
+        with open(self.journal_file, "w") as journal_file:
+            journal_file.write(json.dumps({"key": csr_file, "state": "pending"}) + "\n")
+            journal_file.write('{"key": "' + csr_file + '", "sta')
+        journal = acme_certs.OrderJournal(self.journal_file)
+        self.assertEqual(journal.entries, {csr_file: {"state": "pending"}})
+
+        # Another run cut short mid-line while this one has the journal open
+        with open(self.journal_file, "a") as journal_file:
+            journal_file.write('{"key": "' + csr_file + '", "state": "val')
+        journal.write(csr_file, state="ready")
+        self.assertEqual(journal.entry(csr_file), {"state": "ready"})
+        self.assertEqual(acme_certs.OrderJournal(self.journal_file).entries,
+                         {csr_file: {"state": "ready"}})
+
+
+class LeaseManagerTest(MockTestCase):
+
+    def test_taken_over_after_ttl(self):
+        lease_dir = os.path.join(self.work, "leases")
+        first = acme_certs.LeaseManager(lease_dir, "A", ttl=0.6)
+        second = acme_certs.LeaseManager(lease_dir, "B", ttl=0.6)
+        self.addCleanup(second.close)
+        self.assertEqual(first.claim("a.example.com"), "claimed")
+        self.assertEqual(second.claim("a.example.com"), "held")
+        # A worker that stops renewing its leases loses them once ttl has passed
+        first.close()
+        time.sleep(0.8)
+        self.assertFalse(first.holds("a.example.com"))
+        self.assertEqual(second.claim("a.example.com"), "claimed")
+        self.assertTrue(second.holds("a.example.com"))
+        first.release("a.example.com", ok=False)
+        second.release("a.example.com")
+        self.assertEqual(first.claim("a.example.com"), "done")
+
+    def test_heartbeat_survives_io_errors(self):
+        leases = acme_certs.LeaseManager(os.path.join(self.work, "leases"), "A", ttl=0.6)
+        self.addCleanup(leases.close)
+        self.assertEqual(leases.claim("a.example.com"), "claimed")
+        with mock.patch("os.utime", side_effect=OSError(errno.ESTALE, "Stale file handle")):
+            time.sleep(0.6)
+            self.assertFalse(leases.holds("a.example.com"))
+        time.sleep(0.4)
+        self.assertTrue(leases.heartbeat.is_alive())
+        self.assertTrue(leases.holds("a.example.com"))
+
+    def test_lost_lease_abandons_order(self):
+        leases = acme_certs.LeaseManager(os.path.join(self.work, "leases"), "A", ttl=1.5)
+        self.addCleanup(leases.close)
+        journal = acme_certs.OrderJournal(self.journal_file)
+        session = self.session(journal=journal, leases=leases)
+        checks = []
+        holds = leases.holds
+
+        def lose_once(cert_name, directory="."):
+            # Lost right after newOrder, then taken over again once it expires
+            checks.append(cert_name)
+            return holds(cert_name, directory) and len(checks) != 2
+
+        with mock.patch.object(leases, "holds", lose_once):
+            results = acme_certs.run_batch(session, ["a.example.com"], leases=leases,
+                                           directory=self.work)
+        self.assertEqual(results, {"a.example.com": None})
+        self.assertEqual(len(self.ca.orders), 1)
+        self.assertEqual(self.do_api.records, {})
+
+
+class BudgetTrackerTest(unittest.TestCase):
+
+    DIRECTORY = "https://ca.example/directory"
+    LIMITS = {DIRECTORY: {"orders": (3, 3600), "certificates": (2, 3600)}}
+
+    def setUp(self):
+        self.budget_file = os.path.join(tempfile.mkdtemp(prefix="acme_certs_test"), "budget.json")
+
+    def test_two_trackers_merge(self):
+        first = acme_certs.BudgetTracker(self.budget_file, self.LIMITS)
+        second = acme_certs.BudgetTracker(self.budget_file, self.LIMITS)
+        self.assertTrue(first.reserve(self.DIRECTORY, ["a.example.com"]))
+        first.settle(self.DIRECTORY, ["a.example.com"], issued=True)
+        self.assertTrue(second.reserve(self.DIRECTORY, ["b.example.com"]))
+        second.settle(self.DIRECTORY, ["b.example.com"], issued=True)
+        first.flush()
+        second.flush()
+
+        merged = acme_certs.BudgetTracker(self.budget_file, self.LIMITS)
+        self.assertEqual(merged.remaining(self.DIRECTORY, ["c.example.org"]), 1)
+        # Both certificates count against example.com, and renewals are exempt
+        self.assertEqual(merged.remaining(self.DIRECTORY, ["c.example.com"]), 0)
+        self.assertEqual(merged.remaining(self.DIRECTORY, ["a.example.com"], renewal=True), 1)
+        self.assertTrue(merged.reserve(self.DIRECTORY, ["a.example.com"], renewal=True))
+        self.assertFalse(merged.reserve(self.DIRECTORY, ["d.example.org"]))
+
+    def test_block_is_shared(self):
+        first = acme_certs.BudgetTracker(self.budget_file, self.LIMITS)
+        second = acme_certs.BudgetTracker(self.budget_file, self.LIMITS)
+        first.block(self.DIRECTORY, 3600)
+        second.failed(self.DIRECTORY, "a.example.com")
+        second.flush()
+        self.assertEqual(
+            acme_certs.BudgetTracker(self.budget_file, self.LIMITS).remaining(
+                self.DIRECTORY, ["b.example.com"]), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()